@@ -7,7 +7,8 @@ import networkx as nx
 import numpy as np
 import wandb
 
-from utilities.utils import decompose_sparse_adjacency
+from data_utils.subgraph_extraction import get_num_edges_per_cluster
+from utilities.utils import decompose_sparse_adjacency, to_canonical_csr
 
 
 class ClusteringStatistics:
@@ -64,15 +65,39 @@ class ClusteringStatistics:
             return 0
         return 1 - (num_non_zero_elements / num_elements)
 
+    @staticmethod
+    def split_into_disjoint_runs(clusters, num_nodes):
+        """Splits the list of clusters into consecutive runs of clusters
+        that don't share any node."""
+        in_run = np.zeros(num_nodes, dtype=bool)
+        runs = [[]]
+        for cluster in clusters:
+            if in_run[cluster].any():
+                in_run[np.concatenate(runs[-1])] = False
+                runs.append([])
+            in_run[cluster] = True
+            runs[-1].append(cluster)
+        return [run for run in runs if run]
+
     @staticmethod
     def get_sparsity_ratio_for_clusters(full_adjacency, clusters):
         """Returns the sparsity ratio of each of the provided clusters which
-        are part of the full graph adjacency full_adjacency."""
+        are part of the full graph adjacency full_adjacency. The edges of
+        each run of disjoint clusters are counted in a single pass over
+        the adjacency, rather than slicing it for every cluster."""
+        full_adjacency = to_canonical_csr(full_adjacency)
         sparsity_ratios = []
-        for cluster in clusters:
-            cluster_adj = full_adjacency[cluster, :][:, cluster]
-            sparsity_ratio = ClusteringStatistics.get_sparsity_ratio(cluster_adj)
-            sparsity_ratios.append(sparsity_ratio)
+        for run in ClusteringStatistics.split_into_disjoint_runs(
+                clusters, full_adjacency.shape[0]):
+            nodes_per_cluster = [len(cluster) for cluster in run]
+            cluster_offsets = np.zeros(len(run) + 1, dtype=np.int64)
+            np.cumsum(nodes_per_cluster, out=cluster_offsets[1:])
+            edges_per_cluster = get_num_edges_per_cluster(
+                full_adjacency, np.concatenate(run), cluster_offsets)
+            for num_nodes, num_edges in zip(nodes_per_cluster, edges_per_cluster):
+                num_elements = num_nodes * num_nodes
+                sparsity_ratios.append(
+                    1 - (num_edges / num_elements) if num_elements else 0)
         return sparsity_ratios
 
     @staticmethod
@@ -13,20 +13,36 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
 import logging
 import math
 import os
 import time
-from tqdm import tqdm
 from pathlib import Path
 
 import metis
 import networkx as nx
 import numpy as np
+import scipy.sparse as sp
 
+from data_utils.subgraph_extraction import get_num_edges_per_cluster
 from utilities.constants import AdjacencyForm, MethodMaxNodesEdges
 from utilities.constants import CLUSTERING_CACHE_EXT
-from utilities.utils import decompose_sparse_adjacency
+from utilities.utils import decompose_sparse_adjacency, to_canonical_csr
+
+
+def get_cluster_node_ordering(clusters):
+    """
+    Returns the nodes of all the clusters sorted by cluster, and the
+    offset where each cluster starts, so that the nodes of cluster `c`
+    are `cluster_nodes[cluster_offsets[c]:cluster_offsets[c + 1]]`.
+    This lets the nodes of a batch of clusters be gathered with
+    contiguous copies.
+    """
+    cluster_offsets = np.zeros(len(clusters) + 1, dtype=np.int32)
+    np.cumsum([len(cluster) for cluster in clusters], out=cluster_offsets[1:])
+    cluster_nodes = np.concatenate(clusters).astype(np.int32)
+    return cluster_nodes, cluster_offsets
 
 
 class ClusterGraph:
@@ -54,11 +70,13 @@ class ClusterGraph:
                  node_edge_imbalance_ratio=None,
                  seed=1,
                  regenerate_cluster_cache=True,
-                 save_clustering_cache=True):
+                 save_clustering_cache=True,
+                 base_partition=None):
         """
         Initialises the class
-        :param adjacency: Adjacency matrix in compressed sparse row
-            representation (CSR).
+        :param adjacency: Adjacency matrix. It is converted once to
+            compressed sparse row representation (CSR), so the edges of
+            each node are contiguous when slicing the clusters.
         :param clusters_per_batch: The number of clusters to include in
             a single batch of data.
         :param visible_nodes: The original indices of nodes visible during
@@ -90,6 +108,10 @@ class ClusterGraph:
             dense (i.e., tensor), tf.SparseTensor, or tuple.
         :param seed: Seed for Metis random generator.
         :regenerate_cluster_cache: Bool to set regeneration of clustering cache or not.
+        :param base_partition: Optional ClusterGraph, already clustered
+            into the same number of clusters on a subgraph of this graph.
+            If provided, its clusters are extended to the visible nodes
+            instead of running METIS again, and no cache is used.
         """
 
         if num_clusters is None and max_nodes_per_batch is None:
@@ -110,7 +132,7 @@ class ClusterGraph:
                                  f" {num_clusters}. Ensure it is less than"
                                  " or equal to.")
 
-        self.adjacency = adjacency
+        self.adjacency = to_canonical_csr(adjacency)
         self.clusters_per_batch = clusters_per_batch
         self.dataset_name = dataset_name
         self.cache_dir = cache_dir
@@ -127,7 +149,12 @@ class ClusterGraph:
         self.method_max_nodes = method_max_nodes
         self.method_max_edges = method_max_edges
         self.seed = seed
+        self.base_partition = base_partition
         self._clusters = None
+        # The node ordering of the clusters, with the clusters it was
+        # computed from.
+        self._cluster_ordering = None
+        self._graph_fingerprint = None
 
         if node_edge_imbalance_ratio is not None:
             assert (len(node_edge_imbalance_ratio) == 2 and
@@ -150,6 +177,13 @@ class ClusterGraph:
         else:
             self.num_clusters = num_clusters
 
+        if (self.base_partition is not None and
+                self.base_partition.num_clusters != self.num_clusters):
+            raise ValueError("The base partition has"
+                             f" {self.base_partition.num_clusters} clusters,"
+                             f" but {self.num_clusters} clusters have been"
+                             " requested. They must be the same.")
+
     @staticmethod
     def get_num_clusters(num_nodes, max_nodes_per_batch, clusters_per_batch):
         """Returns the number of clusters required given the number of nodes
@@ -194,9 +228,11 @@ class ClusterGraph:
                 raise ValueError("`cluster_graph` must be run before accessing"
                                  " max_edges_per_batch.")
             logging.info("Counting the number of edges per cluster...")
-            num_edges_per_cluster = [
-                self.adjacency[pt, :][:, pt].sum() for pt in tqdm(self._clusters)
-            ]
+            num_edges_per_cluster = get_num_edges_per_cluster(
+                self.adjacency,
+                self.cluster_nodes,
+                self.cluster_offsets
+            ).tolist()
 
             max_edges_per_batch = self.get_max(
                 self.method_max_edges,
@@ -228,6 +264,29 @@ class ClusterGraph:
                              " clusters.")
         return self._clusters
 
+    @property
+    def cluster_ordering(self):
+        """
+        The nodes of all the clusters sorted by cluster and the offset of
+        each cluster, as returned by `get_cluster_node_ordering`. When the
+        clustering is loaded from the cache these are the memory mapped
+        arrays themselves.
+        """
+        clusters = self.clusters
+        if self._cluster_ordering is None or self._cluster_ordering[0] is not clusters:
+            self._cluster_ordering = (clusters, *get_cluster_node_ordering(clusters))
+        return self._cluster_ordering[1:]
+
+    @property
+    def cluster_nodes(self):
+        """The nodes of all the clusters, sorted by cluster."""
+        return self.cluster_ordering[0]
+
+    @property
+    def cluster_offsets(self):
+        """The offset of each cluster in `cluster_nodes`."""
+        return self.cluster_ordering[1]
+
     @property
     def use_cluster_cache(self):
         return self.cache_dir and self.dataset_name
@@ -238,9 +297,32 @@ class ClusterGraph:
             f"{self.dataset_name}-{self.adjacency_form.name}-"
             f"{self.method_max_nodes.name}-{self.method_max_edges.name}-"
             f"{self.inter_cluster_ratio}-{self.node_edge_imbalance_ratio}-"
-            f"{self.clusters_per_batch}"
+            f"{self.clusters_per_batch}-{self.graph_fingerprint}"
         )
 
+    @property
+    def graph_fingerprint(self):
+        """
+        Short hash of the graph and of the clustering settings that
+        change the result, so a cache computed for a different version
+        of the dataset or different settings isn't loaded. The edges and
+        the visible nodes are hashed, not only counted, as a different
+        edge set can have the same number of edges. The graph is hashed
+        once, on the first access, as it is read for every cached array.
+        """
+        if self._graph_fingerprint is None:
+            key = (self.num_all_nodes, self.adjacency.nnz, self.num_nodes,
+                   self.directed_graph, self.seed)
+            digest = hashlib.sha1(repr(key).encode())
+            for array in (self.adjacency.indptr,
+                          self.adjacency.indices,
+                          np.asarray(self.idx_nodes)):
+                array = np.ascontiguousarray(array)
+                digest.update(array.dtype.str.encode())
+                digest.update(array.data)
+            self._graph_fingerprint = digest.hexdigest()[:8]
+        return self._graph_fingerprint
+
     @staticmethod
     def get_max(method_max, num_per_cluster, num_sampled_clusters):
         """
@@ -293,6 +375,11 @@ class ClusterGraph:
         clustering is found, then it clusters the graph and saves the
         result for future faster loading.
         """
+        if self.base_partition is not None:
+            logging.info(f"Extending the base partition to graph with name {self.dataset_name}...")
+            self.compute_clustering()
+            return
+
         if self.use_cluster_cache and not self.regenerate_cluster_cache:
             if self.load():
                 logging.info("Clustering loaded from cache successfully.")
@@ -311,7 +398,9 @@ class ClusterGraph:
 
         start_time = time.time()
 
-        if self.num_clusters > 1:
+        if self.base_partition is not None and self.num_clusters > 1:
+            groups = self.extend_partition(self.base_partition.clusters)
+        elif self.num_clusters > 1:
             adjacency_to_cluster = self.adjacency.copy()
 
             # METIS cannot cluster a directed graph so we first make
@@ -403,6 +492,53 @@ class ClusterGraph:
 
         logging.info(f"Clustering completed in {time.time() - start_time :.3f} seconds.")
 
+    def extend_partition(self, base_clusters):
+        """
+        Assigns each visible node to a cluster of the given partition.
+        Nodes in the partition keep their cluster, and the rest join the
+        cluster most of their already assigned neighbours belong to,
+        spreading out from the partition. Any node left unreachable is
+        spread evenly over the clusters.
+        :param base_clusters: List of arrays with the original indices of
+            the nodes in each cluster.
+        :return: Array with the cluster of each visible node.
+        """
+        idx_nodes = np.asarray(self.idx_nodes)
+        node_to_cluster = np.full(self.num_all_nodes, -1, dtype=np.int32)
+        for cluster_idx, cluster in enumerate(base_clusters):
+            node_to_cluster[cluster] = cluster_idx
+        # Only the visible nodes can be clustered.
+        is_visible = np.zeros(self.num_all_nodes, dtype=bool)
+        is_visible[idx_nodes] = True
+        node_to_cluster[~is_visible] = -1
+
+        adjacency = sp.csr_matrix(self.adjacency)
+        if self.directed_graph:
+            adjacency = sp.csr_matrix(adjacency + adjacency.transpose())
+
+        unassigned = idx_nodes[node_to_cluster[idx_nodes] < 0]
+        while unassigned.size > 0:
+            # Count the clusters of the assigned neighbours of each
+            # unassigned node.
+            neighbours = adjacency[unassigned, :]
+            neighbour_clusters = node_to_cluster[neighbours.indices]
+            rows = np.repeat(np.arange(unassigned.size), np.diff(neighbours.indptr))
+            is_assigned = neighbour_clusters >= 0
+            cluster_counts = sp.csr_matrix(
+                (np.ones(np.count_nonzero(is_assigned), dtype=np.int32),
+                 (rows[is_assigned], neighbour_clusters[is_assigned])),
+                shape=(unassigned.size, self.num_clusters))
+            has_assigned_neighbours = np.diff(cluster_counts.indptr) > 0
+            if not has_assigned_neighbours.any():
+                break
+            majority_clusters = np.asarray(cluster_counts.argmax(axis=1)).ravel()
+            node_to_cluster[unassigned[has_assigned_neighbours]] = (
+                majority_clusters[has_assigned_neighbours])
+            unassigned = unassigned[~has_assigned_neighbours]
+
+        node_to_cluster[unassigned] = np.arange(unassigned.size) % self.num_clusters
+        return node_to_cluster[idx_nodes]
+
     def validate_clusters(self):
         """Validates the results of the clustering."""
         clustered_nodes = np.array([])
@@ -430,8 +566,13 @@ class ClusterGraph:
 
     def save(self):
         """Save the results of clustering to file."""
-        self.save_param_to_cache("clusters",
-                                 self.clusters)
+        # The clusters are saved as two flat arrays rather than a
+        # pickled list of arrays, so they can be memory mapped on load.
+        cluster_nodes, cluster_offsets = self.cluster_ordering
+        self.save_param_to_cache("cluster_nodes",
+                                 cluster_nodes)
+        self.save_param_to_cache("cluster_offsets",
+                                 cluster_offsets)
         self.save_param_to_cache("max_nodes_per_batch",
                                  self.max_nodes_per_batch)
         self.save_param_to_cache("max_edges_per_batch",
@@ -450,7 +591,14 @@ class ClusterGraph:
 
     def load(self):
         """Load clustering from a file."""
-        self._clusters = self.load_param_from_cache("clusters")
+        cluster_nodes = self.load_param_from_cache("cluster_nodes", mmap_mode="r")
+        cluster_offsets = self.load_param_from_cache("cluster_offsets")
+        self._clusters = None
+        if cluster_nodes is not None and cluster_offsets is not None:
+            # Each cluster is a view into the memory mapped nodes, which
+            # are also given as they are to the batch generator.
+            self._clusters = np.split(cluster_nodes, cluster_offsets[1:-1])
+            self._cluster_ordering = (self._clusters, cluster_nodes, cluster_offsets)
         self._max_nodes_per_batch = self.load_param_from_cache("max_nodes_per_batch")
         self._max_edges_per_batch = self.load_param_from_cache("max_edges_per_batch")
         if (self._clusters is not None and
@@ -467,8 +615,11 @@ class ClusterGraph:
         else:
             return False
 
-    def load_param_from_cache(self, param_name):
-        """Loads param with param_name from a numpy file."""
+    def load_param_from_cache(self, param_name, mmap_mode=None):
+        """
+        Loads param with param_name from a numpy file. If `mmap_mode` is
+        given, the array is memory mapped from the file instead of read.
+        """
         file_name = self.get_cache_file_name(param_name)
         cache_path = Path(self.cache_dir).absolute().joinpath(file_name)
         if cache_path.is_file():
@@ -476,6 +627,8 @@ class ClusterGraph:
                 f"Loading {param_name} from cache {cache_path}, if this isn't"
                 " desired either remove this file or set"
                 " --regenerate-clustering-cache to `True`.")
+            if mmap_mode is not None:
+                return np.load(cache_path, mmap_mode=mmap_mode)
             with open(cache_path, 'rb') as f:
                 return np.load(f, allow_pickle=True)
         return None
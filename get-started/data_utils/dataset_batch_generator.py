@@ -13,15 +13,70 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
+import logging
+import shutil
+from pathlib import Path
+
 import numpy as np
 import scipy.sparse as sp
 import tensorflow as tf
 
+from data_utils.subgraph_extraction import (compile_subgraph_extraction,
+                                            extract_subgraph_edges,
+                                            take_rows)
 from utilities.constants import AdjacencyForm, MASKED_LABEL_VALUE
-from utilities.utils import decompose_sparse_adjacency
+from utilities.utils import (decompose_sparse_adjacency, get_num_available_cpus,
+                             to_canonical_csr)
 
 
 SELF_EDGE_DUMMY_VALUE = -1
+# TensorFlow can use the memory of an array returned from a numpy
+# function without copying it only if it is aligned like the memory
+# TensorFlow allocates itself.
+TENSOR_ALIGNMENT_BYTES = 64
+
+
+def empty_aligned(shape, dtype, alignment=TENSOR_ALIGNMENT_BYTES):
+    """
+    Returns a new uninitialised array, whose data is aligned to the
+    given number of bytes.
+    """
+    dtype = np.dtype(dtype)
+    num_bytes = int(np.prod(shape)) * dtype.itemsize
+    buffer = np.empty(num_bytes + alignment, dtype=np.uint8)
+    offset = -buffer.ctypes.data % alignment
+    return buffer[offset:offset + num_bytes].view(dtype).reshape(shape)
+
+
+def get_narrowest_labels_dtype(labels):
+    """
+    Returns the narrowest signed integer dtype that can hold all the
+    labels and the masked label value. Labels that are not integers
+    keep their dtype.
+    """
+    if not np.issubdtype(labels.dtype, np.integer):
+        return labels.dtype
+    low = min(labels.min(initial=MASKED_LABEL_VALUE), MASKED_LABEL_VALUE)
+    high = max(labels.max(initial=MASKED_LABEL_VALUE), MASKED_LABEL_VALUE)
+    for dtype in (np.int8, np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return np.dtype(dtype)
+    return labels.dtype
+
+
+def get_batches_fingerprint(arrays, params):
+    """
+    Returns a short hash of the arrays and parameters the batches are
+    assembled from, to tell apart the snapshots of different batches.
+    """
+    digest = hashlib.sha1(repr(params).encode())
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(repr((array.shape, array.dtype.str)).encode())
+        digest.update(array.data)
+    return digest.hexdigest()[:16]
 
 
 def add_self_edges_with_dummy_values(adjacency):
@@ -60,10 +115,31 @@ def set_self_edges_values_to_zero(data):
     return data
 
 
+def normalise_adjacency_rows(adjacency):
+    """
+    Normalises each row of a dense adjacency in place by its sum, the
+    degree of the node in the batch, as the "normalised" adjacency
+    transform of the model does, A' = D^(-1) @ A.
+    """
+    degree = adjacency.sum(axis=1, dtype=np.float32)
+    adjacency *= (1.0 / np.maximum(degree, 1.0))[:, np.newaxis].astype(adjacency.dtype)
+
+
+def normalise_edge_values_by_row(rows, values, num_nodes):
+    """
+    Normalises in place the values of an edge list by the sum of the
+    values in their row, which is the same as `normalise_adjacency_rows`
+    for the adjacency given by the edges.
+    """
+    degree = np.bincount(rows, weights=values, minlength=num_nodes)
+    values *= (1.0 / np.maximum(degree, 1.0))[rows].astype(values.dtype)
+
+
 def pad_adjacency_tuple(adjacency,
                         adjacency_dtype,
                         max_edges,
-                        max_nodes):
+                        max_nodes,
+                        indices_dtype=np.int32):
     """
     Converts adjacency to a tuple of indices, values and shape, and pad
     the indices and values to a fixed size. The indices are padded with
@@ -71,6 +147,12 @@ def pad_adjacency_tuple(adjacency,
     gap between the maximum number of edges in any batch and the number
     of edges in the current batch, plus some extra room for inter cluster
     edges. The values are padded to zero.
+
+    The edges are returned in CSR order, that is grouped by row in
+    increasing order, and the padding edges go last as the fake node is
+    the largest. This keeps the row-wise aggregations over contiguous
+    edges and the self-edges in node order, which the sparse tuple ops
+    rely on.
     """
     # Pad the nodes of the sparse adjacency by changing its shape.
     adjacency.resize((max_nodes, max_nodes))
@@ -80,37 +162,64 @@ def pad_adjacency_tuple(adjacency,
     indices, values, _ = set_self_edge_dummy_values_to_zero(
         adjacency)
 
-    # Ensure values is the correct dtype
-    values = values.astype(adjacency_dtype)
+    return pad_edge_list(indices[:, 0],
+                         indices[:, 1],
+                         values,
+                         adjacency_dtype,
+                         max_edges,
+                         max_nodes,
+                         indices_dtype)
+
+
+def pad_edge_list(rows,
+                  cols,
+                  values,
+                  adjacency_dtype,
+                  max_edges,
+                  max_nodes,
+                  indices_dtype=np.int32):
+    """
+    Clip or pad an edge list in CSR order, given as the rows and columns
+    of the edges, and its values, to a fixed number of edges. See
+    `pad_adjacency_tuple` for the details.
+    """
+    # The edges are written straight into the fixed size outputs,
+    # casting to the output dtypes on the way, so no intermediate
+    # edge list is built in the wider dtype of the inputs.
+    indices_out = empty_aligned((max_edges, 2), indices_dtype)
+    values_out = empty_aligned((max_edges,), adjacency_dtype)
 
     # Get the number of edges in the current batch and
     # clip or pad to a fixed number of edges as needed.
-    num_edges_in_batch = indices.shape[0]
+    num_edges_in_batch = rows.shape[0]
     if num_edges_in_batch > max_edges:
         keep = np.random.choice(
             np.arange(0, num_edges_in_batch),
             size=max_edges,
             replace=False
         )
-        indices = indices[keep, :]
-        values = values[keep]
+        # Sample the edges without breaking the CSR order.
+        keep.sort()
+        indices_out[:, 0] = rows[keep]
+        indices_out[:, 1] = cols[keep]
+        values_out[:] = values[keep]
     else:
-        edge_padding = (0, max_edges - num_edges_in_batch)
+        indices_out[:num_edges_in_batch, 0] = rows
+        indices_out[:num_edges_in_batch, 1] = cols
+        values_out[:num_edges_in_batch] = values
         # Add the new edges for padding to a fake node.
         fake_node_id = max_nodes - 1
         # Pad the edge list with self connections on this fake node.
-        indices = np.pad(
-            indices,
-            (edge_padding, (0, 0)),
-            constant_values=fake_node_id)
+        indices_out[num_edges_in_batch:] = fake_node_id
         # Pad the value list with zeros for the corresponding padded edges.
-        values = np.pad(values, edge_padding, constant_values=0)
-    return indices, values
+        values_out[num_edges_in_batch:] = 0
+    return indices_out, values_out
 
 
 def tf_dataset_generator(
     adjacency,
-    clusters,
+    cluster_nodes,
+    cluster_offsets,
     features,
     labels,
     mask,
@@ -120,114 +229,201 @@ def tf_dataset_generator(
     max_edges_per_batch,
     adjacency_dtype,
     adjacency_form,
+    adjacency_indices_dtype=np.int32,
     micro_batch_size=1,
     seed=None,
     deterministic=False,
-    prefetch_depth=10,
+    prefetch_depth=tf.data.AUTOTUNE,
     distributed_worker_count=1,
-    distributed_worker_index=0
+    distributed_worker_index=0,
+    cache_dataset=False,
+    snapshot_dir=None,
+    regenerate_snapshot=False,
+    normalise_adjacency=False
 ):
-    """Create a tf.data.Dataset of batches."""
+    """
+    Create a tf.data.Dataset of batches.
+
+    The labels of the batches are in the narrowest integer dtype that
+    can hold them, as given by `get_narrowest_labels_dtype`.
+
+    The clusters are given by `cluster_nodes`, the nodes of all the
+    clusters sorted by cluster, and `cluster_offsets`, the offset where
+    each cluster starts in `cluster_nodes`, as returned by
+    `get_cluster_node_ordering`.
+
+    If `cache_dataset` is set, the clusters are not shuffled and the
+    batches assembled in the first pass over the clusters are cached
+    and replayed for every following pass. This suits evaluation,
+    where the combination of clusters per batch doesn't need to change
+    between passes.
+
+    If `snapshot_dir` is also set, the batches of the first pass are
+    written to a snapshot in a subdirectory of it, named after a
+    fingerprint of the inputs, and later runs with the same inputs read
+    them back instead of assembling them again. An existing snapshot is
+    removed first if `regenerate_snapshot` is set.
+
+    If `normalise_adjacency` is set, the adjacency of each batch is
+    normalised by the degree of the nodes in the batch, as the
+    "normalised" adjacency transform would do in the model, so the
+    model can skip it. The adjacency dtype must then be a float.
+    """
+    # The instance count and index are read once here, and sharding is
+    # then done by the tf.data shard op, with no per batch Python work.
+    distributed_worker_count = int(distributed_worker_count)
+    distributed_worker_index = int(distributed_worker_index)
+    if not 0 <= distributed_worker_index < distributed_worker_count:
+        raise ValueError(f"The distributed worker index {distributed_worker_index}"
+                         f" is out of range for {distributed_worker_count} workers.")
+    if distributed_worker_count > num_clusters:
+        raise ValueError(f"There are fewer clusters ({num_clusters}) than"
+                         f" distributed workers ({distributed_worker_count}),"
+                         " so some workers would have no batches.")
+
+    if normalise_adjacency and not np.issubdtype(adjacency_dtype, np.floating):
+        raise ValueError("A normalised adjacency must be fed as a float, not"
+                         f" {np.dtype(adjacency_dtype).name}.")
+
+    if snapshot_dir is not None and not cache_dataset:
+        raise ValueError("A snapshot of the batches can only be used along with"
+                         " `cache_dataset`, as the batches must be the same"
+                         " in every pass.")
 
     # Create a list of cluster indices that are cheaper to shuffle
     # than the full clusters list.
     cluster_indices = np.arange(num_clusters)
 
-    # Convert cluster list of numpy arrays to list of lists, so that
-    # concatenation is cheaper within the batch generation.
-    cluster_lists = [list(c) for c in clusters]
+    # The nodes of each cluster are contiguous in `cluster_nodes`, so the
+    # positions of the nodes in a batch are a range per cluster. These
+    # are computed with TensorFlow ops in the input pipeline, which only
+    # needs the small offsets array.
+    cluster_offsets_tensor = tf.constant(cluster_offsets)
 
-    # Define a closure so this function has access to cluster_lists
-    def get_nodes_from_cluster_indices(selected_cluster_indices):
-        nodes_in_batch_list = []
-        for cluster_idx in selected_cluster_indices:
-            nodes_in_batch_list += cluster_lists[cluster_idx]
-        return np.array(nodes_in_batch_list)
+    def get_node_positions_from_cluster_indices(selected_cluster_indices):
+        starts = tf.gather(cluster_offsets_tensor, selected_cluster_indices)
+        limits = tf.gather(cluster_offsets_tensor, selected_cluster_indices + 1)
+        return tf.ragged.range(starts, limits).flat_values
+
+    # The features are gathered for every batch, so make sure the rows
+    # are contiguous in memory. They are already in the dtype the model
+    # consumes, so no cast is needed per batch.
+    features = np.ascontiguousarray(features)
 
     # Create mask and apply to labels
     # The mask will be regenerated in the loss function based
-    # on the value the masked labels are set to here.
-    labels = labels.copy()
+    # on the value the masked labels are set to here, so the labels
+    # are the only tensor carrying the mask. They are fed in the
+    # narrowest dtype that holds them, to cut the bytes per batch.
+    labels = labels.astype(get_narrowest_labels_dtype(labels))
     mask = ~tf.cast(mask, tf.bool)
     labels[mask, :] = MASKED_LABEL_VALUE
 
     # For sparse operations, the matrix shape must be static, so we only need
     # two inputs: edges and values.
-    if adjacency_form in (AdjacencyForm.SPARSE_TENSOR, AdjacencyForm.SPARSE_TUPLE):
-        adjacency_type = (tf.int32, adjacency_dtype)
-    else:
+    if adjacency_form == AdjacencyForm.SPARSE_TUPLE:
+        adjacency_type = (adjacency_indices_dtype, adjacency_dtype)
+    elif adjacency_form == AdjacencyForm.DENSE:
         adjacency_type = adjacency_dtype
+    else:
+        # A SparseTensor would add a tensor per batch and a dynamic
+        # shape, so sparse adjacencies are always fed as padded tuples.
+        raise ValueError(f"Unsupported adjacency form {adjacency_form} for the"
+                         " batch generator. Use either the dense or the"
+                         " sparse tuple form.")
+
+    # The subgraph of each batch is sliced from the rows of a CSR
+    # adjacency, so convert it once here rather than per batch.
+    adjacency = to_canonical_csr(adjacency)
+
+    if snapshot_dir is not None:
+        # The masked labels also carry the mask of the split. The
+        # features are too large to hash on every run, so only a strided
+        # sample of their rows is hashed along with their shape. Use
+        # `regenerate_snapshot` after changing only some of the rows.
+        features_sample = features[::max(1, features.shape[0] // 1024)]
+        snapshot_path = Path(snapshot_dir).joinpath("batches-" + get_batches_fingerprint(
+            (cluster_nodes, cluster_offsets, labels, adjacency.indptr,
+             adjacency.indices, adjacency.data, features_sample),
+            (adjacency.shape, adjacency.nnz, features.shape, features.dtype.str,
+             num_clusters, clusters_per_batch, max_nodes_per_batch, max_edges_per_batch,
+             np.dtype(adjacency_dtype).str, adjacency_form.name,
+             np.dtype(adjacency_indices_dtype).str, micro_batch_size,
+             distributed_worker_count, distributed_worker_index, normalise_adjacency)))
+        if regenerate_snapshot and snapshot_path.exists():
+            logging.info(f"Removing the snapshot of the batches in {snapshot_path}...")
+            shutil.rmtree(snapshot_path)
 
     # Do the expensive parts of the sparse tuple preprocessing
     # ahead of time.
     if adjacency_form == AdjacencyForm.SPARSE_TUPLE:
         adjacency = add_self_edges_with_dummy_values(adjacency)
     else:
-        # We can cast the adjacency here for the sparse tensor and
-        # dense case. For the sparse tuple we require the self edges
+        # We can cast the adjacency here for the dense case.
+        # For the sparse tuple we require the self edges
         # to have a dummy value which can't be represented as bool so
         # we cast later.
         adjacency = adjacency.astype(adjacency_dtype)
-
-    def fix_output_shape_adjacency_dense(adjacency_batch,
-                                         features_batch,
-                                         labels_batch):
+    # The subgraph of each batch is extracted straight from the
+    # CSR arrays.
+    adjacency = sp.csr_matrix(adjacency)
+    # The shapes and dtypes of the batches are fixed from here on, so
+    # specialise the extraction kernels for them once, up front.
+    compile_subgraph_extraction(adjacency, cluster_nodes.dtype, (features, labels))
+
+    def fix_outputs_shape_feats_labels(features_batch, labels_batch):
+        features_batch.set_shape((max_nodes_per_batch, features.shape[1]))
+        labels_batch.set_shape((max_nodes_per_batch, labels.shape[1]))
+
+    # The static shapes are set and the batch is arranged into model
+    # inputs and labels in a single map, to keep the per batch work
+    # of the pipeline to one stage after the assembly.
+    def structure_batch_adjacency_dense(adjacency_batch,
+                                        features_batch,
+                                        labels_batch):
         # We must feed the IPU with a fixed shape tensor,
         # which for the dense representation is achieved by
         # padding with dummy nodes.
         adjacency_batch.set_shape((max_nodes_per_batch, max_nodes_per_batch))
-        return adjacency_batch, features_batch, labels_batch
-
-    def fix_output_shape_adjacency_sparse_tensor(indices_batch,
-                                                 values_batch,
-                                                 features_batch,
-                                                 labels_batch):
-        # We only use SparseTensor on CPU so can get away with not
-        # specifying a fixed shape.
-        indices_batch.set_shape((None, 2))
-        values_batch.set_shape((None,))
-        return indices_batch, values_batch, features_batch, labels_batch
+        fix_outputs_shape_feats_labels(features_batch, labels_batch)
+        return (
+            dict(
+                adjacency_batch=adjacency_batch,
+                features_batch=features_batch
+            ),
+            labels_batch
+        )
 
-    def fix_output_shape_adjacency_sparse_tuple(indices_batch,
-                                                values_batch,
-                                                features_batch,
-                                                labels_batch):
+    def structure_batch_adjacency_sparse_tuple(indices_batch,
+                                               values_batch,
+                                               features_batch,
+                                               labels_batch):
         # We must feed the IPU with a tuple with fixed size, which is
         # achieved by padding when needed.
         indices_batch.set_shape((max_edges_per_batch, 2))
         values_batch.set_shape((max_edges_per_batch,))
-        return indices_batch, values_batch, features_batch, labels_batch
-
-    def fix_outputs_shape_feats_labels(x_batch, y_batch):
-        x_batch["features_batch"].set_shape((max_nodes_per_batch, features.shape[1]))
-        y_batch.set_shape((max_nodes_per_batch, labels.shape[1]))
-        return x_batch, y_batch
+        fix_outputs_shape_feats_labels(features_batch, labels_batch)
+        return (
+            dict(
+                adjacency_batch=(indices_batch, values_batch),
+                features_batch=features_batch
+            ),
+            labels_batch
+        )
 
     def process_adjacency_dense(nodes_in_batch,
                                 features_batch,
                                 labels_batch):
-        adjacency_batch = adjacency[nodes_in_batch, :][:, nodes_in_batch]
-        adjacency_batch = adjacency_batch.toarray()
-        if max_nodes_per_batch > nodes_in_batch.size:
-            # Convert to a dense matrix and pad with zero.
-            node_padding = (0, max_nodes_per_batch - nodes_in_batch.size)
-            adjacency_batch = np.pad(
-                adjacency_batch, (node_padding, node_padding))
+        rows, cols, edge_ids = extract_subgraph_edges(adjacency, nodes_in_batch)
+        # Scatter the edges into a dense matrix padded with zeros.
+        adjacency_batch = empty_aligned((max_nodes_per_batch, max_nodes_per_batch),
+                                        adjacency.dtype)
+        adjacency_batch[...] = 0
+        adjacency_batch[rows, cols] = adjacency.data[edge_ids]
+        if normalise_adjacency:
+            normalise_adjacency_rows(adjacency_batch)
         return adjacency_batch, features_batch, labels_batch
 
-    def process_adjacency_sparse_tensor(nodes_in_batch,
-                                        features_batch,
-                                        labels_batch):
-        adjacency_batch = adjacency[nodes_in_batch, :][:, nodes_in_batch]
-        # Pad the nodes of the sparse adjacency by changing its shape.
-        adjacency_batch.resize((max_nodes_per_batch, max_nodes_per_batch))
-        # Convert sparse matrix to a tuple that can be consumed by
-        # tf.data.Dataset.from_generator.
-        # We won't need the shape as it is a constant value.
-        indices_batch, values_batch, _ = decompose_sparse_adjacency(
-            adjacency_batch.asformat("coo"))
-        return indices_batch, values_batch, features_batch, labels_batch
-
     def process_adjacency_sparse_tuple(nodes_in_batch,
                                        features_batch,
                                        labels_batch):
@@ -239,19 +435,27 @@ def tf_dataset_generator(
         of edges in the current batch, plus some extra room for inter cluster
         edges. The values are padded to zero.
         """
-        adjacency_batch = adjacency[nodes_in_batch, :][:, nodes_in_batch]
-        indices_batch, values_batch = pad_adjacency_tuple(
-            adjacency_batch,
+        rows, cols, edge_ids = extract_subgraph_edges(adjacency, nodes_in_batch)
+        # Remove dummy values but keeping the self-edges.
+        values_batch = set_self_edges_values_to_zero(adjacency.data[edge_ids])
+        indices_batch, values_batch = pad_edge_list(
+            rows,
+            cols,
+            values_batch,
             adjacency_dtype,
             max_edges_per_batch,
-            max_nodes_per_batch
+            max_nodes_per_batch,
+            adjacency_indices_dtype
         )
+        if normalise_adjacency:
+            # The degrees are taken over the edges kept in the batch.
+            normalise_edge_values_by_row(
+                indices_batch[:, 0], values_batch, max_nodes_per_batch)
         return indices_batch, values_batch, features_batch, labels_batch
 
     def select_pad_features_and_labels(nodes_in_batch):
         num_nodes_in_batch = nodes_in_batch.size
         do_pad_nodes = max_nodes_per_batch > num_nodes_in_batch
-        node_padding = None
 
         if not do_pad_nodes:
             keep = np.random.choice(
@@ -260,114 +464,68 @@ def tf_dataset_generator(
                 replace=False
             )
             nodes_in_batch = nodes_in_batch[keep]
+        num_nodes = nodes_in_batch.size
+
+        # Gather the rows straight into the padded outputs. These are
+        # allocated for every batch, as TensorFlow may keep using the
+        # memory of the arrays it is given. The gather runs without the
+        # GIL, so other batches can be assembled meanwhile.
+        features_batch = empty_aligned((max_nodes_per_batch, features.shape[1]),
+                                       features.dtype)
+        labels_batch = empty_aligned((max_nodes_per_batch, labels.shape[1]),
+                                     labels.dtype)
+        take_rows(features, nodes_in_batch, features_batch[:num_nodes])
+        take_rows(labels, nodes_in_batch, labels_batch[:num_nodes])
+        features_batch[num_nodes:] = 0
+        labels_batch[num_nodes:] = MASKED_LABEL_VALUE
+        return nodes_in_batch, features_batch, labels_batch
 
-        features_batch = features[nodes_in_batch, :]
-        labels_batch = labels[nodes_in_batch, :]
+    if adjacency_form == AdjacencyForm.DENSE:
+        process_adjacency = process_adjacency_dense
+        batch_types = (adjacency_type, features.dtype, labels.dtype)
+    elif adjacency_form == AdjacencyForm.SPARSE_TUPLE:
+        process_adjacency = process_adjacency_sparse_tuple
+        batch_types = (*adjacency_type, features.dtype, labels.dtype)
 
-        if do_pad_nodes:
-            node_padding = (0, max_nodes_per_batch - nodes_in_batch.size)
-            features_batch = np.pad(features_batch, (node_padding, (0, 0)))
-            labels_batch = np.pad(
-                labels_batch,
-                (node_padding, (0, 0)),
-                constant_values=MASKED_LABEL_VALUE
-            )
-        return nodes_in_batch, features_batch, labels_batch
+    def assemble_batch(node_positions):
+        """
+        Gathers and pads the features, labels and adjacency of all the
+        clusters in a batch in a single call, so the cost of crossing
+        into Python is paid once per batch.
+        """
+        nodes_in_batch = cluster_nodes[node_positions]
+        nodes_in_batch, features_batch, labels_batch = select_pad_features_and_labels(
+            nodes_in_batch)
+        return process_adjacency(nodes_in_batch, features_batch, labels_batch)
 
     dataset = tf.data.Dataset.from_tensor_slices(cluster_indices)
+    # Shard the cluster indices, rather than the assembled batches, so
+    # each instance only does the work for its own batches.
     if distributed_worker_count > 1:
         dataset = dataset.shard(num_shards=distributed_worker_count,
                                 index=distributed_worker_index)
-    dataset = dataset.shuffle(num_clusters, seed=seed)
-    dataset = dataset.repeat()
+    if not cache_dataset:
+        # Only the scalar cluster indices are shuffled, before any batch
+        # is assembled, so the buffer holds one int per cluster and a
+        # new order is drawn for every epoch.
+        dataset = dataset.shuffle(num_clusters, seed=seed)
+        dataset = dataset.repeat()
     dataset = dataset.batch(clusters_per_batch)
 
+    # Assemble each batch of clusters with a single call.
     dataset = dataset.map(
         lambda clusters_in_batch:
             tf.numpy_function(
-                get_nodes_from_cluster_indices,
-                [clusters_in_batch],
-                clusters[0].dtype),
-        num_parallel_calls=10,
-        deterministic=deterministic)
-
-    # Pad features and labels
-    dataset = dataset.map(
-        lambda nodes_in_batch:
-            tf.numpy_function(
-                select_pad_features_and_labels,
-                [nodes_in_batch],
-                (nodes_in_batch.dtype, features.dtype, labels.dtype)),
-        num_parallel_calls=5,
+                assemble_batch,
+                [get_node_positions_from_cluster_indices(clusters_in_batch)],
+                batch_types),
+        num_parallel_calls=tf.data.AUTOTUNE,
         deterministic=deterministic)
 
     if adjacency_form == AdjacencyForm.DENSE:
-        dataset = dataset.map(
-            lambda nodes_in_batch, feats, labels:
-                tf.numpy_function(
-                    process_adjacency_dense,
-                    [nodes_in_batch, feats, labels],
-                    (adjacency_type, features.dtype, labels.dtype)),
-            num_parallel_calls=5,
-            deterministic=deterministic)
-        dataset = dataset.map(fix_output_shape_adjacency_dense)
-        dataset = dataset.map(
-            lambda adj, feats, labels:
-            (
-                dict(
-                    adjacency_batch=adj,
-                    features_batch=feats
-                ),
-                labels
-            )
-        )
+        dataset = dataset.map(structure_batch_adjacency_dense)
     elif adjacency_form == AdjacencyForm.SPARSE_TUPLE:
-        dataset = dataset.map(
-            lambda nodes_in_batch, feats, labels:
-                tf.numpy_function(
-                    process_adjacency_sparse_tuple,
-                    [nodes_in_batch, feats, labels],
-                    (adjacency_type[0], adjacency_type[1], features.dtype, labels.dtype)),
-            num_parallel_calls=5,
-            deterministic=deterministic)
-        dataset = dataset.map(fix_output_shape_adjacency_sparse_tuple)
-        dataset = dataset.map(
-            lambda adj_indices, adj_values, feats, labels:
-            (
-                dict(
-                    adjacency_batch=(adj_indices, adj_values),
-                    features_batch=feats
-                ),
-                labels
-            )
-        )
-    elif adjacency_form == AdjacencyForm.SPARSE_TENSOR:
-        dataset = dataset.map(
-            lambda nodes_in_batch, feats, labels:
-                tf.numpy_function(
-                    process_adjacency_sparse_tensor,
-                    [nodes_in_batch, feats, labels],
-                    (adjacency_type[0], adjacency_type[1], features.dtype, labels.dtype)),
-            num_parallel_calls=5,
-            deterministic=deterministic)
-        dataset = dataset.map(fix_output_shape_adjacency_sparse_tensor)
-        dataset = dataset.map(
-            lambda adj_indices, adj_values, feats, labels:
-            (
-                dict(
-                    adjacency_batch=tf.sparse.SparseTensor(
-                        indices=tf.cast(adj_indices, tf.int64),
-                        values=adj_values,
-                        dense_shape=tf.cast((max_nodes_per_batch, max_nodes_per_batch), tf.int64)
-                    ),
-                    features_batch=feats
-                ),
-                labels
-            )
-        )
-
-    # Define shapes of features and labels
-    dataset = dataset.map(fix_outputs_shape_feats_labels)
+        dataset = dataset.map(structure_batch_adjacency_sparse_tuple)
 
     if adjacency_form == AdjacencyForm.SPARSE_TUPLE:
         assert micro_batch_size == 1, (
@@ -378,5 +536,38 @@ def tf_dataset_generator(
                                 num_parallel_calls=5,
                                 deterministic=deterministic)
 
+    if snapshot_dir is not None:
+        # Write the batches to disk in the first run and read them back
+        # in the following ones.
+        logging.info(f"Using the snapshot of the batches in {snapshot_path}.")
+        dataset = dataset.apply(
+            tf.data.experimental.snapshot(str(snapshot_path), compression=None))
+
+    if cache_dataset:
+        # Assemble the batches once and replay them on every pass.
+        dataset = dataset.cache()
+        dataset = dataset.repeat()
+
+    # Let the tf.data runtime tune the prefetch buffer unless a fixed
+    # depth has been requested.
+    if prefetch_depth is None:
+        prefetch_depth = tf.data.AUTOTUNE
     dataset = dataset.prefetch(prefetch_depth)
+
+    # Unless determinism is requested, batches can be produced out of
+    # order, so a slow batch doesn't hold back the ones behind it.
+    options = tf.data.Options()
+    options.deterministic = deterministic
+    options.experimental_optimization.map_and_batch_fusion = True
+    options.experimental_optimization.map_fusion = True
+    options.experimental_optimization.map_parallelization = True
+    options.experimental_optimization.parallel_batch = True
+    # Size the input pipeline threads to the CPUs this instance can
+    # run on, so instances sharing a host don't oversubscribe it.
+    options.threading.private_threadpool_size = get_num_available_cpus()
+    # Each distributed instance already reads only its own shard of the
+    # clusters, so the dataset must not be sharded again by a strategy.
+    options.experimental_distribute.auto_shard_policy = (
+        tf.data.experimental.AutoShardPolicy.OFF)
+    dataset = dataset.with_options(options)
     return dataset
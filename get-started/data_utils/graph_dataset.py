@@ -13,11 +13,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import copy
 import gzip
 import logging
 import inspect
 import os
 import pickle
+from pathlib import Path
 
 import numpy as np
 import scipy.sparse as sp
@@ -32,6 +34,13 @@ class GraphDataset:
     """Base class for graph datasets holding the data and transforms
     to apply to the dataset. This should not be used directly, instead
     use its child classes."""
+
+    # Attributes saved as separate arrays alongside the preprocessed
+    # dataset, so they can be memory mapped when loading rather than
+    # being read fully into memory. An attribute holding the same array
+    # as a previous one is saved once and shares its mapping on load.
+    MEMORY_MAPPED_ATTRIBUTES = ("features", "features_train")
+
     def __init__(self,
                  dataset_name,
                  total_num_nodes,
@@ -243,11 +252,39 @@ class GraphDataset:
 
         return masked_features
 
+    @staticmethod
+    def get_memory_mapped_attribute_path(file_path, attribute):
+        """Path of the array saved for an attribute of the dataset
+        preprocessed in `file_path`."""
+        file_path = Path(file_path)
+        file_name = file_path.name
+        if file_name.endswith(PICKLE_GZ_EXT):
+            file_name = file_name[:-len(PICKLE_GZ_EXT)]
+        return file_path.with_name(f"{file_name}_{attribute}.npy")
+
     def save(self, file_path):
         """Saves the preprocessed dataset data to file."""
         logging.info(f"Saving processed dataset to {file_path}...")
+        dataset_to_pickle = copy.copy(self)
+        dataset_to_pickle.shared_memory_mapped_attributes = dict()
+        saved_attributes = []
+        for attribute in self.MEMORY_MAPPED_ATTRIBUTES:
+            array = getattr(self, attribute, None)
+            if not isinstance(array, np.ndarray):
+                continue
+            shared_with = [saved for saved in saved_attributes
+                           if getattr(self, saved) is array]
+            if shared_with:
+                dataset_to_pickle.shared_memory_mapped_attributes[attribute] = shared_with[0]
+            else:
+                attribute_path = self.get_memory_mapped_attribute_path(file_path, attribute)
+                np.save(attribute_path, array)
+                # Give user rw, group rw and all r permissions
+                os.chmod(attribute_path, 0o664)
+                saved_attributes.append(attribute)
+            delattr(dataset_to_pickle, attribute)
         with gzip.open(file_path, "wb") as f:
-            pickle.dump(self, f, protocol=4)
+            pickle.dump(dataset_to_pickle, f, protocol=4)
         # Give user rw, group rw and all r permissions
         os.chmod(file_path, 0o664)
 
@@ -270,21 +307,48 @@ class GraphDataset:
             # Give user rw, group rw and all r permissions
             os.chmod(attrib_filename, 0o664)
 
+        # The features are saved as arrays, as in `save`, so they can be
+        # memory mapped when loading.
+        shared_memory_mapped_attributes = dict()
+        saved_arrays = []
         for attribute in [*self.__dict__]:
-            save_attribute(attribute)
+            array = getattr(self, attribute)
+            if attribute in self.MEMORY_MAPPED_ATTRIBUTES and isinstance(array, np.ndarray):
+                shared_with = [saved for saved in saved_arrays
+                               if getattr(self, saved) is array]
+                if shared_with:
+                    shared_memory_mapped_attributes[attribute] = shared_with[0]
+                else:
+                    array_path = f"{base_directory}{attribute}.npy"
+                    np.save(array_path, array)
+                    # Give user rw, group rw and all r permissions
+                    os.chmod(array_path, 0o664)
+                    saved_arrays.append(attribute)
+            else:
+                save_attribute(attribute)
 
         # Svae meta info including the key word args for base class to load into
         base_args_spec = inspect.getargspec(inspect.getmro(type(self))[1].__init__)
         self.meta_info = {"attributes_to_load": [*self.__dict__],
                           "type": type(self),
-                          "base_args_spec": base_args_spec}
+                          "base_args_spec": base_args_spec,
+                          "shared_memory_mapped_attributes": shared_memory_mapped_attributes}
         save_attribute("meta_info")
 
     @classmethod
     def load_preprocessed_dataset(cls, file_path):
-        """Loads the preprocessed dataset from file."""
+        """Loads the preprocessed dataset from file. The attributes
+        saved as separate arrays are memory mapped read only."""
         f = gzip.open(str(file_path), 'rb')
         dataset = pickle.load(f)
+        if isinstance(dataset, GraphDataset):
+            for attribute in cls.MEMORY_MAPPED_ATTRIBUTES:
+                attribute_path = cls.get_memory_mapped_attribute_path(file_path, attribute)
+                if not hasattr(dataset, attribute) and attribute_path.is_file():
+                    setattr(dataset, attribute, np.load(attribute_path, mmap_mode="r"))
+            shared_attributes = getattr(dataset, "shared_memory_mapped_attributes", dict())
+            for attribute, shared_with in shared_attributes.items():
+                setattr(dataset, attribute, getattr(dataset, shared_with))
         return dataset
 
     @classmethod
@@ -299,24 +363,36 @@ class GraphDataset:
         # Take the args (ignoring cls)
         init_dict = dict()
         for var in init_vars.args[1:]:
-            var_filename = f"{base_directory}{var}{PICKLE_GZ_EXT}"
-            init_dict[var] = cls.load_preprocessed_dataset(var_filename)
+            init_dict[var] = cls.load_mag240_attribute(base_directory, var)
         # Take the class type from meta_info and unpack the vars in as keywords
         dataset = meta_info["type"](**init_dict)
 
+        shared_attributes = meta_info.get("shared_memory_mapped_attributes", dict())
         addition_vars = list(
-            set(meta_info["attributes_to_load"]).difference(init_vars.args[1:])
+            set(meta_info["attributes_to_load"])
+            .difference(init_vars.args[1:])
+            .difference(shared_attributes)
         )
         for var in addition_vars:
-            var_filename = f"{base_directory}{var}{PICKLE_GZ_EXT}"
             setattr(
                 dataset,
                 var,
-                cls.load_preprocessed_dataset(var_filename)
+                cls.load_mag240_attribute(base_directory, var)
             )
+        for attribute, shared_with in shared_attributes.items():
+            setattr(dataset, attribute, getattr(dataset, shared_with))
 
         return dataset
 
+    @classmethod
+    def load_mag240_attribute(cls, base_directory, attribute):
+        """Loads an attribute of the MAG 240 dataset saved by `save_mag`.
+        The attributes saved as arrays are memory mapped read only."""
+        array_path = Path(f"{base_directory}{attribute}.npy")
+        if attribute in cls.MEMORY_MAPPED_ATTRIBUTES and array_path.is_file():
+            return np.load(array_path, mmap_mode="r")
+        return cls.load_preprocessed_dataset(f"{base_directory}{attribute}{PICKLE_GZ_EXT}")
+
 
 class HomogeneousGraphDataset(GraphDataset):
     """Homogeneous graph dataset class holding the data and transforms
@@ -391,19 +467,38 @@ class HomogeneousGraphDataset(GraphDataset):
     def normalize_features(self):
         """Normalizes all features based on the training feature."""
         logging.info(f"Normalizing the features in dataset...")
-        self.features_train = self.normalize(self.features_train, self.dataset_splits["train"])
+        # When the training features are the full features, keep a
+        # single array rather than normalizing it twice.
+        features_shared = self.features_train is self.features
         self.features = self.normalize(self.features, self.dataset_splits["train"])
+        if features_shared:
+            self.features_train = self.features
+        else:
+            self.features_train = self.normalize(self.features_train, self.dataset_splits["train"])
 
     def features_to_dtype(self, dtype):
         """Casts all features to dtype."""
         logging.info(f"Casting the features in dataset to dtype {dtype.__name__}...")
-        self.features_train = self.features_train.astype(dtype)
-        self.features = self.features.astype(dtype)
+        # Casting makes a copy of the features, so avoid it when they
+        # already have the dtype, and cast the training features only
+        # if they are a separate array.
+        features_shared = self.features_train is self.features
+        self.features = self.features.astype(dtype, copy=False)
+        if features_shared:
+            self.features_train = self.features
+        else:
+            self.features_train = self.features_train.astype(dtype, copy=False)
         return self
 
     def labels_to_dtype(self, dtype):
         """Casts all labels to dtype."""
         logging.info(f"Casting the labels in dataset to dtype {dtype.__name__}...")
+        if np.issubdtype(dtype, np.integer) and self.labels.size:
+            info = np.iinfo(dtype)
+            if self.labels.min() < info.min or self.labels.max() > info.max:
+                raise ValueError(f"The labels in the dataset range from"
+                                 f" {self.labels.min()} to {self.labels.max()},"
+                                 f" which doesn't fit in {dtype.__name__}.")
         self.labels = self.labels.astype(dtype)
         return self
 
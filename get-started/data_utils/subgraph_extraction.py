@@ -0,0 +1,166 @@
+# Copyright (c) 2022 Graphcore Ltd. All rights reserved.
+
+import numba
+import numpy as np
+
+
+# The per batch kernels run serially. They are called concurrently from
+# the parallel calls of the input pipeline, which already keep the CPUs
+# busy, and nested parallel regions can deadlock the Numba threading
+# layer. Releasing the GIL is what lets the batches overlap.
+@numba.njit(nogil=True, cache=True)
+def count_subgraph_edges(indptr, indices, nodes, local_ids):
+    """
+    Counts, for each node in the subgraph, the number of its edges
+    whose receiver is also in the subgraph.
+    """
+    counts = np.zeros(nodes.size, dtype=np.int64)
+    for i in range(nodes.size):
+        node = nodes[i]
+        count = 0
+        for edge in range(indptr[node], indptr[node + 1]):
+            if local_ids[indices[edge]] >= 0:
+                count += 1
+        counts[i] = count
+    return counts
+
+
+@numba.njit(nogil=True, cache=True)
+def fill_subgraph_edges(indptr, indices, nodes, local_ids, offsets,
+                        rows, cols, edge_ids):
+    """
+    Fills the edges of the subgraph with the row and column relative to
+    the position of the nodes in the subgraph, and the position of the
+    edge in the original adjacency. The edges are written in CSR order.
+    """
+    for i in range(nodes.size):
+        node = nodes[i]
+        out = offsets[i]
+        for edge in range(indptr[node], indptr[node + 1]):
+            col = local_ids[indices[edge]]
+            if col >= 0:
+                rows[out] = i
+                cols[out] = col
+                edge_ids[out] = edge
+                out += 1
+
+
+@numba.njit(parallel=True, nogil=True, cache=True)
+def count_intra_cluster_edges(indptr, indices, node_clusters):
+    """
+    Counts, for each node, the number of its edges whose receiver is in
+    the same cluster, given the cluster of each node, or -1 for the
+    nodes not in any cluster.
+    """
+    num_nodes = indptr.size - 1
+    counts = np.zeros(num_nodes, dtype=np.int64)
+    for node in numba.prange(num_nodes):
+        cluster = node_clusters[node]
+        if cluster < 0:
+            continue
+        count = 0
+        for edge in range(indptr[node], indptr[node + 1]):
+            if node_clusters[indices[edge]] == cluster:
+                count += 1
+        counts[node] = count
+    return counts
+
+
+def get_num_edges_per_cluster(adjacency, cluster_nodes, cluster_offsets):
+    """
+    Counts the edges inside each cluster in a single pass over the
+    adjacency, which is equivalent to
+    `[adjacency[nodes, :][:, nodes].nnz for nodes in clusters]` but
+    avoids slicing the adjacency for every cluster.
+    :param adjacency: Adjacency matrix in compressed sparse row
+        representation (CSR).
+    :param cluster_nodes: The nodes of all the clusters sorted by
+        cluster, as returned by `get_cluster_node_ordering`.
+    :param cluster_offsets: The offset where each cluster starts in
+        `cluster_nodes`.
+    :return: Array with the number of edges in each cluster.
+    """
+    num_clusters = cluster_offsets.size - 1
+    node_clusters = np.full(adjacency.shape[0], -1, dtype=np.int32)
+    node_clusters[cluster_nodes] = np.repeat(
+        np.arange(num_clusters, dtype=np.int32), np.diff(cluster_offsets))
+    counts = count_intra_cluster_edges(
+        adjacency.indptr, adjacency.indices, node_clusters)
+    return np.bincount(node_clusters[cluster_nodes],
+                       weights=counts[cluster_nodes],
+                       minlength=num_clusters).astype(np.int64)
+
+
+@numba.njit(nogil=True, cache=True)
+def gather_rows(source, rows, out):
+    """
+    Copies the given rows of `source` into `out` without holding the
+    GIL. It runs serially like the other per batch kernels.
+    """
+    for i in range(rows.size):
+        out[i, :] = source[rows[i], :]
+
+
+def take_rows(source, rows, out):
+    """
+    Gathers the given rows of a 2D array into `out`, which is equivalent
+    to `np.take(source, rows, axis=0, out=out)`. The rows are copied as
+    raw bytes, so this works for any dtype, including float16.
+    :param source: 2D array with contiguous rows, for example a memory
+        mapped array.
+    :param rows: Array with the indices of the rows to gather.
+    :param out: C-contiguous 2D array of the same dtype as `source`,
+        with a row for each index in `rows`.
+    """
+    gather_rows(_as_byte_rows(source), rows, _as_byte_rows(out))
+
+
+def _as_byte_rows(array):
+    row_size = int(np.prod(array.shape[1:]))
+    return array.reshape(array.shape[0], row_size).view(np.uint8)
+
+
+def extract_subgraph_edges(adjacency, nodes):
+    """
+    Extracts the edges of the subgraph induced by the given nodes, which
+    is equivalent to `adjacency[nodes, :][:, nodes]` but avoids building
+    the intermediate sparse matrices.
+    :param adjacency: Adjacency matrix in compressed sparse row
+        representation (CSR).
+    :param nodes: Array with the original indices of the nodes in the
+        subgraph. The subgraph nodes are numbered in this order.
+    :return: Tuple of the rows and columns of the edges in the subgraph,
+        as int32 arrays in CSR order, and the position of each edge in
+        the data of the original adjacency.
+    """
+    # Map from the original node indices to the subgraph ones,
+    # with -1 for the nodes not in the subgraph.
+    local_ids = np.full(adjacency.shape[1], -1, dtype=np.int32)
+    local_ids[nodes] = np.arange(nodes.size, dtype=np.int32)
+
+    counts = count_subgraph_edges(
+        adjacency.indptr, adjacency.indices, nodes, local_ids)
+    offsets = np.zeros(nodes.size + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    num_edges = offsets[-1]
+    rows = np.empty(num_edges, dtype=np.int32)
+    cols = np.empty(num_edges, dtype=np.int32)
+    edge_ids = np.empty(num_edges, dtype=np.int64)
+    fill_subgraph_edges(adjacency.indptr, adjacency.indices, nodes, local_ids,
+                        offsets, rows, cols, edge_ids)
+    return rows, cols, edge_ids
+
+
+def compile_subgraph_extraction(adjacency, nodes_dtype=np.int32, node_arrays=()):
+    """
+    Compiles the subgraph extraction kernels for the index dtypes of the
+    given adjacency and nodes, by extracting an empty subgraph, and the
+    row gather for each of the given per node arrays. This makes sure
+    the compilation is done once, ahead of the first batch, rather than
+    by the first input pipeline threads that need it.
+    """
+    nodes = np.empty(0, dtype=nodes_dtype)
+    extract_subgraph_edges(adjacency, nodes)
+    for array in node_arrays:
+        take_rows(array, nodes, np.empty((0, *array.shape[1:]), dtype=array.dtype))
@@ -13,7 +13,8 @@ def get_optimizer(
     beta_1=0.9,
     beta_2=0.999,
     epsilon=1e-06,
-    loss_scaling=None
+    loss_scaling=None,
+    use_ipu_optimizer=True
 ):
     """Constructs and returns a Keras optimizer
     Args:
@@ -29,6 +30,12 @@ def get_optimizer(
         epsilon: A small constant for numerical stability.
         loss_scaling: A float representing the fixed loss scaling. If None,
             the loss will not be scaled.
+        use_ipu_optimizer: A flag to use the IPU Adam optimizer. If False,
+            the Keras Adam optimizer is used, which updates each variable
+            with a single fused kernel on the CPU. The gradients are cast
+            back to the dtype of each variable for that kernel, and the
+            moments have the dtype of the variables. They are float32 in
+            the drivers, as float16 precision is only allowed on the IPU.
     """
 
     def scale_gradients_by_replicas_and_grad_accum(grads_and_vars):
@@ -39,16 +46,32 @@ def get_optimizer(
         scale = gradient_accumulation_steps_per_replica * num_replicas
         return [(tf.cast(g, dtype=optimizer_compute_precision) / scale, v) for g, v in grads_and_vars]
 
-    optimizer = AdamIpuOptimizer(
-        optimizer_compute_precisions=(optimizer_compute_precision, ),
-        learning_rate=learning_rate,
-        beta_1=beta_1,
-        beta_2=beta_2,
-        epsilon=epsilon,
-        m_dtype=optimizer_compute_precision,
-        v_dtype=optimizer_compute_precision,
-        gradient_transformers=[scale_gradients_by_replicas_and_grad_accum]
-    )
+    def cast_gradients_to_variables_dtype(grads_and_vars):
+        # The fused Keras Adam kernel needs the gradient and the variable
+        # in the same dtype, while the transformers above compute the
+        # gradients in the optimizer compute precision.
+        return [(tf.cast(g, dtype=v.dtype), v) for g, v in grads_and_vars]
+
+    if use_ipu_optimizer:
+        optimizer = AdamIpuOptimizer(
+            optimizer_compute_precisions=(optimizer_compute_precision, ),
+            learning_rate=learning_rate,
+            beta_1=beta_1,
+            beta_2=beta_2,
+            epsilon=epsilon,
+            m_dtype=optimizer_compute_precision,
+            v_dtype=optimizer_compute_precision,
+            gradient_transformers=[scale_gradients_by_replicas_and_grad_accum]
+        )
+    else:
+        optimizer = tf.keras.optimizers.Adam(
+            learning_rate=learning_rate,
+            beta_1=beta_1,
+            beta_2=beta_2,
+            epsilon=epsilon,
+            gradient_transformers=[scale_gradients_by_replicas_and_grad_accum,
+                                   cast_gradients_to_variables_dtype]
+        )
 
     if loss_scaling is not None:
         optimizer = StaticLossScaleOptimizer(optimizer, loss_scaling, optimizer_compute_precision)
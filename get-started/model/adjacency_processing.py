@@ -30,6 +30,7 @@ class AdjacencyProcessing(tf.keras.layers.Layer):
             regularisation=None,
             adjacency_form=AdjacencyForm.DENSE,
             adjacency_dtype=tf.float32,
+            precompute_normalisation=False,
             **kwargs
     ):
         """
@@ -43,6 +44,9 @@ class AdjacencyProcessing(tf.keras.layers.Layer):
             as a dense tensor, a sparse tensor, or a tuple.
         :param cast_model_inputs_to_dtype: TF dtype to cast the values of the adjacency
             matrix when it is . If the matrix is dense, then this parameter is not used.
+        :param precompute_normalisation: Whether the adjacency values have already
+            been normalised by the degree of the nodes in the batch, by the batch
+            generator, in which case the normalisation is skipped.
         """
         super().__init__(**kwargs)
 
@@ -52,6 +56,7 @@ class AdjacencyProcessing(tf.keras.layers.Layer):
         self.regularisation = regularisation
         self.adjacency_form = adjacency_form
         self.adjacency_dtype = adjacency_dtype
+        self.precompute_normalisation = precompute_normalisation
 
     @staticmethod
     def normalise_adjacency(adjacency):
@@ -88,7 +93,7 @@ class AdjacencyProcessing(tf.keras.layers.Layer):
             raise ValueError(f"Not valid 'adjacency_mode', "
                              f"it must be one of {ALLOWED_ADJACENCY_TRANSFORM}.")
 
-        # If adjacency matrix is a tf.Tensor, cast from bool to the chosen float precision.
+        # If adjacency matrix is a tf.Tensor, cast to the chosen float precision.
         if isinstance(adjacency, tf.Tensor):
             adjacency = tf.cast(adjacency, dtype=self.adjacency_dtype)
 
@@ -102,6 +107,8 @@ class AdjacencyProcessing(tf.keras.layers.Layer):
             # Option 1: Eq. (1) from paper.
             # A' denotes A normalised.
             # A_tilde = A'
+            if self.precompute_normalisation:
+                return adjacency
             adj_norm = self.normalise_adjacency(adjacency)
             return adj_norm
 
@@ -109,7 +116,10 @@ class AdjacencyProcessing(tf.keras.layers.Layer):
             # Option 1: Eq. (1) from paper.
             # A' denotes A normalised and regularised.
             # A_tilde = A'
-            adj_norm = self.normalise_adjacency(adjacency)
+            if self.precompute_normalisation:
+                adj_norm = adjacency
+            else:
+                adj_norm = self.normalise_adjacency(adjacency)
             adj_reg_norm = self.regularise_adjacency(
                 adj_norm,
                 self.regularisation,
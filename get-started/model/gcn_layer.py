@@ -19,6 +19,10 @@ class GcnLayer(tf.keras.layers.Layer):
     5. Layer normalise the result. Layer normalisation is used for its better performance
         on the IPU, but it is equivalent to batch normalisation for 2D inputs.
     6. Activation function.
+
+    These are kept as standard ops, rather than a custom fused op, so the layer runs on any
+    device. The features are fed in the compute dtype, so no cast is needed before the sparse
+    product, and the elementwise ops around the matmuls are fused by the Poplar compiler.
     """
 
     def __init__(
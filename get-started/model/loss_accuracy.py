@@ -253,7 +253,9 @@ class MaskedF1Score(tfa.metrics.F1Score):
         # Regenerate the mask from the labels, shape (num_nodes)
         mask = get_mask_from_labels(y_true)
         if self.labels_to_one_hot:
-            y_true = tf.one_hot(tf.reshape(y_true, [-1]),
+            # The labels may be fed in a narrow integer dtype which
+            # one_hot doesn't accept as indices.
+            y_true = tf.one_hot(tf.cast(tf.reshape(y_true, [-1]), tf.int32),
                                 depth=self.num_classes,
                                 dtype=self.metrics_precision)
         # Apply activation to the prediction
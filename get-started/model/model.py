@@ -14,6 +14,8 @@ def define_inputs_with_tensor_adjacency(
         adjacency_form,
         inputs_dtype,
         num_features,
+        features_dtype=None,
+        weighted_adjacency=False
 ):
     assert micro_batch_size == 1, (
         f"A micro_batch_size of {micro_batch_size} has been provided,"
@@ -21,7 +23,12 @@ def define_inputs_with_tensor_adjacency(
 
     strategy = distribution_strategy_context.get_strategy()
 
-    adj_dtype = inputs_dtype if adjacency_form == AdjacencyForm.SPARSE_TENSOR else tf.bool
+    # A dense adjacency is fed as bool to minimize IO, unless it
+    # carries precomputed weights.
+    if adjacency_form == AdjacencyForm.SPARSE_TENSOR or weighted_adjacency:
+        adj_dtype = inputs_dtype
+    else:
+        adj_dtype = tf.bool
     adjacency = tf.keras.Input(
         max_nodes_per_batch,
         batch_size=max_nodes_per_batch * strategy.num_replicas_in_sync,
@@ -32,7 +39,7 @@ def define_inputs_with_tensor_adjacency(
     features = tf.keras.Input(
         num_features,
         batch_size=max_nodes_per_batch * strategy.num_replicas_in_sync,
-        dtype=inputs_dtype,
+        dtype=features_dtype or inputs_dtype,
         name="features"
     )
     return adjacency, features
@@ -43,14 +50,16 @@ def define_inputs_with_tuple_adjacency(
         max_edges_per_batch,
         inputs_dtype,
         num_features,
-        max_nodes_per_batch
+        max_nodes_per_batch,
+        indices_dtype=tf.int32,
+        features_dtype=None
 ):
     strategy = distribution_strategy_context.get_strategy()
 
     adjacency_edges = tf.keras.Input(
         shape=(max_edges_per_batch, 2),
         batch_size=micro_batch_size * strategy.num_replicas_in_sync,
-        dtype=tf.int32,
+        dtype=indices_dtype,
         name="adjacency_edges"
     )
     adjacency_values = tf.keras.Input(
@@ -64,7 +73,7 @@ def define_inputs_with_tuple_adjacency(
     features = tf.keras.Input(
         (max_nodes_per_batch, num_features),
         batch_size=micro_batch_size * strategy.num_replicas_in_sync,
-        dtype=inputs_dtype,
+        dtype=features_dtype or inputs_dtype,
         name="features"
     )
 
@@ -73,9 +82,11 @@ def define_inputs_with_tuple_adjacency(
 
 def squeeze_batch_dim(adjacency, features):
     """Squeeze artefact batch dimension when working with sparse tuple."""
+    # Only the batch dimension is squeezed, so the static shapes of the
+    # inputs carry through the whole model whatever their sizes.
     if isinstance(adjacency, tuple):
-        adjacency_batch = tuple(tf.squeeze(a) for a in adjacency)
-        features_batch = tf.squeeze(features)
+        adjacency_batch = tuple(tf.squeeze(a, axis=0) for a in adjacency)
+        features_batch = tf.squeeze(features, axis=0)
         return adjacency_batch, features_batch
     else:
         return adjacency, features
@@ -94,9 +105,20 @@ def create_model(
         cast_model_inputs_to_dtype=tf.float32,
         first_layer_precalculation=False,
         use_ipu_layers=True,
-        adjacency_form=AdjacencyForm.DENSE
+        adjacency_form=AdjacencyForm.DENSE,
+        adjacency_indices_dtype=tf.int32,
+        features_dtype=None
 ):
-    """Create a GCN model."""
+    """
+    Create a GCN model. All the inputs have static shapes, given by the
+    maximum number of nodes and edges per batch, so the model is traced
+    once and compiled for these shapes.
+    """
+
+    # By default the features are fed in the same dtype as the other
+    # inputs, but the generator may already emit them in the compute dtype.
+    if features_dtype is None:
+        features_dtype = cast_model_inputs_to_dtype
 
     if adjacency_form in [AdjacencyForm.DENSE, AdjacencyForm.SPARSE_TENSOR]:
         adjacency_input, features_input = define_inputs_with_tensor_adjacency(
@@ -104,7 +126,9 @@ def create_model(
             max_nodes_per_batch,
             adjacency_form,
             cast_model_inputs_to_dtype,
-            num_features
+            num_features,
+            features_dtype,
+            weighted_adjacency=adjacency_params.get("precompute_normalisation", False)
         )
     elif adjacency_form == AdjacencyForm.SPARSE_TUPLE:
         adjacency_input, features_input = define_inputs_with_tuple_adjacency(
@@ -112,11 +136,19 @@ def create_model(
             max_edges_per_batch,
             cast_model_inputs_to_dtype,
             num_features,
-            max_nodes_per_batch
+            max_nodes_per_batch,
+            adjacency_indices_dtype,
+            features_dtype
         )
 
     adjacency, hidden = squeeze_batch_dim(adjacency_input, features_input)
 
+    if adjacency_form == AdjacencyForm.SPARSE_TUPLE:
+        # The edges may be fed in a narrower dtype to minimize IO, but
+        # the sparse ops index with int32.
+        adjacency_edges, adjacency_values = adjacency
+        adjacency = (tf.cast(adjacency_edges, tf.int32), adjacency_values)
+
     # Add adjacency matrix preprocessing layer.
     adjacency_processing_layer = AdjacencyProcessing(
         max_nodes_per_batch,
@@ -1,4 +1,6 @@
 # Copyright (c) 2022 Graphcore Ltd. All rights reserved.
+from contextlib import contextmanager
+
 import numpy as np
 import tensorflow as tf
 
@@ -15,7 +17,11 @@ class Precision:
             self.optimizer_compute_precision = tf.float32
             self.matmul_partials_type = "half"
             self.features_precision = tf.float16
-            self.labels_precision = tf.int32
+            # The labels are class ids, or binary values for multi label
+            # tasks, so int16 holds them with half the host memory of
+            # int32. The batches narrow them further when possible, and
+            # the metrics one hot encode the class ids on device.
+            self.labels_precision = tf.int16
         elif precision_str == "fp32":
             self.policy = tf.keras.mixed_precision.Policy("float32")
             self.cast_model_inputs_to_dtype = tf.float32
@@ -23,15 +29,32 @@ class Precision:
             self.optimizer_compute_precision = tf.float32
             self.matmul_partials_type = "float"
             self.features_precision = tf.float32
-            self.labels_precision = tf.int32
+            self.labels_precision = tf.int16
         elif precision_str == "mixed":
             self.policy = tf.keras.mixed_precision.Policy("mixed_float16")
             self.cast_model_inputs_to_dtype = tf.float32
             self.metrics_precision = tf.float32
             self.optimizer_compute_precision = tf.float32
             self.matmul_partials_type = "float"
-            self.features_precision = tf.float32
-            self.labels_precision = tf.int32
+            # The first layer computes in float16, so feeding the features
+            # in float16 halves the IO without losing precision.
+            self.features_precision = tf.float16
+            self.labels_precision = tf.int16
         else:
             raise ValueError(f"Unrecognised precision type: `{precision_str}`."
                              f" Choose one of {ALLOWED_PRECISION_TYPE}")
+
+    @contextmanager
+    def policy_scope(self):
+        """
+        Context manager to create the layers of a model with the
+        precision policy. The previous global policy is restored on exit,
+        so models of different precisions don't depend on the order they
+        are created in.
+        """
+        previous_policy = tf.keras.mixed_precision.global_policy()
+        tf.keras.mixed_precision.set_global_policy(self.policy)
+        try:
+            yield self.policy
+        finally:
+            tf.keras.mixed_precision.set_global_policy(previous_policy)
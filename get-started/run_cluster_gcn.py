@@ -41,21 +41,36 @@ from model.pipeline_stage_names import PIPELINE_ALLOCATE_PREVIOUS, PIPELINE_NAME
 from model.precision import Precision
 from utilities.argparser import add_arguments, combine_config_file_with_args
 from utilities.checkpoint_utility import load_checkpoint_into_model
-from utilities.constants import GraphType
-from utilities.ipu_utils import create_ipu_strategy, set_random_seeds
+from utilities.constants import AdjacencyForm, GraphType
+from utilities.ipu_utils import (create_ipu_strategy, get_feed_queue_depth, set_executable_cache_path,
+                                 set_random_seeds)
 from utilities.options import Options
 from utilities.pipeline_stage_assignment import pipeline_model
-from utilities.utils import get_adjacency_dtype, get_adjacency_form, get_method_max, get_time_now
+from utilities.utils import (get_adjacency_dtype, get_adjacency_form, get_adjacency_indices_dtype,
+                             get_method_max, get_time_now)
 
 
 def run(config):
     """Run training, validation and evaluation on the model."""
 
+    # Cache the compiled executables, so that rerunning with the same
+    # shapes, for example for validation and test, loads them instead
+    # of compiling.
+    if config.executable_cache_path:
+        set_executable_cache_path(config.executable_cache_path)
+
     # Set how the adjacency matrix is expressed,
-    # namely dense tensor, sparse tensor, or tuple.
+    # namely dense tensor or tuple.
     adjacency_form_training = get_adjacency_form(
         config.training.device,
         config.training.use_sparse_representation)
+    if (adjacency_form_training == AdjacencyForm.SPARSE_TUPLE
+            and not config.model.first_layer_precalculation):
+        logging.warning(
+            "The first layer precalculation is disabled, so the first layer"
+            " product with the adjacency is computed in every step. Set"
+            " `model.first_layer_precalculation` to compute it once when"
+            " preprocessing the dataset instead.")
 
     # Check if `poprun` has initiated distributed training.
     distributed_training = popdist.isPopdistEnvSet()
@@ -84,14 +99,14 @@ def run(config):
 
     logging.info(f"Config: {pformat(config.dict())}")
 
-    # Set precision policy for training
+    # Precision for training, its policy is applied to the training model
     precision = Precision(config.training.precision)
-    tf.keras.mixed_precision.set_global_policy(precision.policy)
 
     # Decide on the dtype of the adjacency matrix
     adjacency_dtype_training = get_adjacency_dtype(
         config.training.device,
-        config.training.use_sparse_representation)
+        config.training.use_sparse_representation,
+        config.model.adjacency.precompute_normalisation)
 
     method_max_edges = get_method_max(config.method_max_edges)
     method_max_nodes = get_method_max(config.method_max_nodes)
@@ -142,10 +157,16 @@ def run(config):
                 num_clusters_per_batch=config.training.clusters_per_batch)
             clustering_statistics.get_statistics(wandb=config.wandb)
 
+        # Edges are fed with the narrowest index dtype that fits the batch.
+        adjacency_indices_dtype_training = get_adjacency_indices_dtype(
+            adjacency_form_training,
+            training_clusters.max_nodes_per_batch)
+
         # Create dataset generators for training
         data_generator_training = tf_dataset_generator(
             adjacency=dataset.adjacency_train,
-            clusters=training_clusters.clusters,
+            cluster_nodes=training_clusters.cluster_nodes,
+            cluster_offsets=training_clusters.cluster_offsets,
             features=dataset.features_train,
             labels=dataset.labels,
             mask=dataset.mask_train,
@@ -155,11 +176,13 @@ def run(config):
             max_edges_per_batch=training_clusters.max_edges_per_batch,
             adjacency_dtype=adjacency_dtype_training,
             adjacency_form=adjacency_form_training,
+            adjacency_indices_dtype=adjacency_indices_dtype_training,
             micro_batch_size=config.training.micro_batch_size,
             seed=config.seed,
             prefetch_depth=config.training.dataset_prefetch_depth,
             distributed_worker_count=popdist.getNumInstances(),
-            distributed_worker_index=popdist.getInstanceIndex()
+            distributed_worker_index=popdist.getInstanceIndex(),
+            normalise_adjacency=config.model.adjacency.precompute_normalisation
         )
         logging.info(
             f"Created batch generator for training: {data_generator_training}")
@@ -227,7 +250,8 @@ def run(config):
             # Create dataset generator for live validation
             data_generator_validation = tf_dataset_generator(
                 adjacency=dataset.adjacency_full,
-                clusters=live_validation_clusters.clusters,
+                cluster_nodes=live_validation_clusters.cluster_nodes,
+                cluster_offsets=live_validation_clusters.cluster_offsets,
                 features=dataset.features,
                 labels=dataset.labels,
                 mask=dataset.mask_validation,
@@ -237,8 +261,14 @@ def run(config):
                 max_edges_per_batch=training_clusters.max_edges_per_batch,
                 adjacency_dtype=adjacency_dtype_training,
                 adjacency_form=adjacency_form_training,
+                adjacency_indices_dtype=adjacency_indices_dtype_training,
                 micro_batch_size=config.training.micro_batch_size,
-                seed=config.seed
+                seed=config.seed,
+                prefetch_depth=config.validation.dataset_prefetch_depth,
+                cache_dataset=True,
+                snapshot_dir=config.evaluation_snapshot_path,
+                regenerate_snapshot=config.regenerate_dataset_cache,
+                normalise_adjacency=config.model.adjacency.precompute_normalisation
             )
 
             # Create a batch config object for live validation to help number of steps etc.
@@ -271,7 +301,7 @@ def run(config):
                 validation_freq=config.training.validation_frequency
             )
 
-        with strategy_training_scope:
+        with strategy_training_scope, precision.policy_scope():
             # Create the model for training
             model_training = create_model(
                 micro_batch_size=config.training.micro_batch_size,
@@ -284,14 +314,23 @@ def run(config):
                 dropout_rate=config.model.dropout,
                 adjacency_params=config.model.adjacency.dict(),
                 cast_model_inputs_to_dtype=precision.cast_model_inputs_to_dtype,
+                features_dtype=precision.features_precision,
                 first_layer_precalculation=config.model.first_layer_precalculation,
                 use_ipu_layers=(config.training.device == "ipu"),
-                adjacency_form=adjacency_form_training
+                adjacency_form=adjacency_form_training,
+                adjacency_indices_dtype=tf.as_dtype(adjacency_indices_dtype_training)
             )
             model_training.summary(print_fn=logging.info)
-            # Set the infeed and outfeed options.
-            model_training.set_infeed_queue_options(prefetch_depth=10)
-            model_training.set_outfeed_queue_options(buffer_depth=10)
+            # Set the infeed and outfeed options. Size them to the number
+            # of steps run per execution so the IPU is not starved by the
+            # infeed or blocked on the outfeed.
+            feed_queue_depth = get_feed_queue_depth(batch_config_training.steps_per_execution)
+            # Staging batches ahead in the infeed lets the I/O tiles transfer
+            # the next batch while the current step is running.
+            infeed_prefetch_depth = (config.training.ipu_config.infeed_prefetch_depth
+                                     or feed_queue_depth)
+            model_training.set_infeed_queue_options(prefetch_depth=infeed_prefetch_depth)
+            model_training.set_outfeed_queue_options(buffer_depth=feed_queue_depth)
 
             if num_pipeline_stages_training > 1 and config.training.device == "ipu":
                 # Pipeline the model if required
@@ -321,7 +360,8 @@ def run(config):
                 num_replicas=popdist.getNumTotalReplicas() if distributed_training else config.training.replicas,
                 learning_rate=tf.cast(config.training.lr, dtype=tf.float32),
                 loss_scaling=config.training.loss_scaling,
-                optimizer_compute_precision=precision.optimizer_compute_precision
+                optimizer_compute_precision=precision.optimizer_compute_precision,
+                use_ipu_optimizer=(config.training.device == "ipu")
             )
 
             # Compile the model
@@ -362,19 +402,19 @@ def run(config):
     if config.do_validation and popdist.getInstanceIndex() == 0:
         logging.info(f"Running validation on {config.validation.device}...")
 
-        # Set precision policy for validation
+        # Precision for validation, its policy is applied to the validation model
         precision = Precision(config.validation.precision)
-        tf.keras.mixed_precision.set_global_policy(precision.policy)
 
         # Set how the adjacency matrix is expressed,
-        # namely dense tensor, sparse tensor, or tuple.
+        # namely dense tensor or tuple.
         adjacency_form_validation = get_adjacency_form(
             config.validation.device,
             config.validation.use_sparse_representation)
         # Decide on the dtype of the adjacency matrix
         adjacency_dtype_validation = get_adjacency_dtype(
             config.validation.device,
-            config.validation.use_sparse_representation)
+            config.validation.use_sparse_representation,
+            config.model.adjacency.precompute_normalisation)
 
         # Cluster the validation graph
         end_validation_clusters = ClusterGraph(
@@ -392,14 +432,26 @@ def run(config):
             inter_cluster_ratio=config.inter_cluster_ratio,
             method_max_nodes=method_max_nodes,
             method_max_edges=method_max_edges,
-            node_edge_imbalance_ratio=config.cluster_node_edge_imbalance_ratio
+            node_edge_imbalance_ratio=config.cluster_node_edge_imbalance_ratio,
+            # The training clustering is extended to the full graph instead of
+            # clustering it again, when both use the same number of clusters.
+            base_partition=(training_clusters
+                            if config.do_training and
+                            config.validation.num_clusters == training_clusters.num_clusters
+                            else None)
         )
         end_validation_clusters.cluster_graph()
 
+        # Edges are fed with the narrowest index dtype that fits the batch.
+        adjacency_indices_dtype_validation = get_adjacency_indices_dtype(
+            adjacency_form_validation,
+            end_validation_clusters.max_nodes_per_batch)
+
         # Create dataset generator for validation
         end_data_generator_validation = tf_dataset_generator(
             adjacency=dataset.adjacency_full,
-            clusters=end_validation_clusters.clusters,
+            cluster_nodes=end_validation_clusters.cluster_nodes,
+            cluster_offsets=end_validation_clusters.cluster_offsets,
             features=dataset.features,
             labels=dataset.labels,
             mask=dataset.mask_validation,
@@ -409,8 +461,14 @@ def run(config):
             max_edges_per_batch=end_validation_clusters.max_edges_per_batch,
             adjacency_dtype=adjacency_dtype_validation,
             adjacency_form=adjacency_form_validation,
+            adjacency_indices_dtype=adjacency_indices_dtype_validation,
             micro_batch_size=config.validation.micro_batch_size,
-            seed=config.seed
+            seed=config.seed,
+            prefetch_depth=config.validation.dataset_prefetch_depth,
+            cache_dataset=True,
+            snapshot_dir=config.evaluation_snapshot_path,
+            regenerate_snapshot=config.regenerate_dataset_cache,
+            normalise_adjacency=config.model.adjacency.precompute_normalisation
         )
         logging.info(
             f"Created batch generator for validation: {end_data_generator_validation}")
@@ -444,7 +502,7 @@ def run(config):
 
         set_random_seeds(config.seed+1)
 
-        with strategy_validation_scope:
+        with strategy_validation_scope, precision.policy_scope():
             # Create the model for validation
             model_validation = create_model(
                 micro_batch_size=config.validation.micro_batch_size,
@@ -457,9 +515,11 @@ def run(config):
                 dropout_rate=config.model.dropout,
                 adjacency_params=config.model.adjacency.dict(),
                 cast_model_inputs_to_dtype=precision.cast_model_inputs_to_dtype,
+                features_dtype=precision.features_precision,
                 first_layer_precalculation=config.model.first_layer_precalculation,
                 use_ipu_layers=(config.validation.device == "ipu"),
-                adjacency_form=adjacency_form_validation
+                adjacency_form=adjacency_form_validation,
+                adjacency_indices_dtype=tf.as_dtype(adjacency_indices_dtype_validation)
             )
 
             # Load weights from training model or from checkpoint
@@ -510,19 +570,19 @@ def run(config):
     if config.do_test and popdist.getInstanceIndex() == 0:
         logging.info(f"Running evaluation on test data on {config.test.device}...")
 
-        # Set the precision policy for testing
+        # Precision for testing, its policy is applied to the test model
         precision = Precision(config.test.precision)
-        tf.keras.mixed_precision.set_global_policy(precision.policy)
 
         # Set how the adjacency matrix is expressed,
-        # namely dense tensor, sparse tensor, or tuple.
+        # namely dense tensor or tuple.
         adjacency_form_test = get_adjacency_form(
             config.test.device,
             config.test.use_sparse_representation)
         # Decide on the dtype of the adjacency matrix
         adjacency_dtype_test = get_adjacency_dtype(
             config.test.device,
-            config.test.use_sparse_representation)
+            config.test.use_sparse_representation,
+            config.model.adjacency.precompute_normalisation)
 
         # Cluster the test graph
         test_clusters = ClusterGraph(
@@ -540,14 +600,26 @@ def run(config):
             inter_cluster_ratio=config.inter_cluster_ratio,
             method_max_nodes=method_max_nodes,
             method_max_edges=method_max_edges,
-            node_edge_imbalance_ratio=config.cluster_node_edge_imbalance_ratio
+            node_edge_imbalance_ratio=config.cluster_node_edge_imbalance_ratio,
+            # The training clustering is extended to the full graph instead of
+            # clustering it again, when both use the same number of clusters.
+            base_partition=(training_clusters
+                            if config.do_training and
+                            config.test.num_clusters == training_clusters.num_clusters
+                            else None)
         )
         test_clusters.cluster_graph()
 
+        # Edges are fed with the narrowest index dtype that fits the batch.
+        adjacency_indices_dtype_test = get_adjacency_indices_dtype(
+            adjacency_form_test,
+            test_clusters.max_nodes_per_batch)
+
         # Create dataset generator for test
         data_generator_test = tf_dataset_generator(
             adjacency=dataset.adjacency_full,
-            clusters=test_clusters.clusters,
+            cluster_nodes=test_clusters.cluster_nodes,
+            cluster_offsets=test_clusters.cluster_offsets,
             features=dataset.features,
             labels=dataset.labels,
             mask=dataset.mask_test,
@@ -557,8 +629,14 @@ def run(config):
             max_edges_per_batch=test_clusters.max_edges_per_batch,
             adjacency_dtype=adjacency_dtype_test,
             adjacency_form=adjacency_form_test,
+            adjacency_indices_dtype=adjacency_indices_dtype_test,
             micro_batch_size=config.test.micro_batch_size,
-            seed=config.seed
+            seed=config.seed,
+            prefetch_depth=config.test.dataset_prefetch_depth,
+            cache_dataset=True,
+            snapshot_dir=config.evaluation_snapshot_path,
+            regenerate_snapshot=config.regenerate_dataset_cache,
+            normalise_adjacency=config.model.adjacency.precompute_normalisation
         )
         logging.info(
             f"Created batch generator for test: {data_generator_test}")
@@ -592,7 +670,7 @@ def run(config):
 
         set_random_seeds(config.seed + 1)
 
-        with strategy_test_scope:
+        with strategy_test_scope, precision.policy_scope():
             # Create the model for test
             model_test = create_model(
                 micro_batch_size=config.test.micro_batch_size,
@@ -605,9 +683,11 @@ def run(config):
                 dropout_rate=config.model.dropout,
                 adjacency_params=config.model.adjacency.dict(),
                 cast_model_inputs_to_dtype=precision.cast_model_inputs_to_dtype,
+                features_dtype=precision.features_precision,
                 first_layer_precalculation=config.model.first_layer_precalculation,
                 use_ipu_layers=(config.test.device == "ipu"),
-                adjacency_form=adjacency_form_test
+                adjacency_form=adjacency_form_test,
+                adjacency_indices_dtype=tf.as_dtype(adjacency_indices_dtype_test)
             )
 
             # Load weights from training model or from checkpoint
@@ -79,13 +79,19 @@ from model.pipeline_stage_names import (
     PIPELINE_NAMES
 )
 from model.precision import Precision
-from utilities.constants import GraphType
-from utilities.ipu_utils import create_ipu_strategy, set_random_seeds
+from utilities.constants import AdjacencyForm, GraphType
+from utilities.ipu_utils import (
+    create_ipu_strategy,
+    get_feed_queue_depth,
+    set_executable_cache_path,
+    set_random_seeds
+)
 from utilities.options import Options
 from utilities.pipeline_stage_assignment import pipeline_model
 from utilities.utils import (
     get_adjacency_dtype,
     get_adjacency_form,
+    get_adjacency_indices_dtype,
     get_method_max
 )
 
@@ -144,21 +150,27 @@ config.training.precision = "fp16"
 config.training.use_sparse_representation = True
 ```
 """
-# Set precision policy for training
+# Precision for training, its policy is applied to the training model
 precision = Precision(config.training.precision)
-tf.keras.mixed_precision.set_global_policy(precision.policy)
 
 # Set how the adjacency matrix is expressed,
-# namely dense (tf.Tensor), dynamic COO representation (tf.sparse.SparseTensor),
-# or static COO representation with padding (tuple).
+# namely dense (tf.Tensor) or static COO representation with padding (tuple).
 adjacency_form_training = get_adjacency_form(
     config.training.device,
     config.training.use_sparse_representation)
+if (adjacency_form_training == AdjacencyForm.SPARSE_TUPLE
+        and not config.model.first_layer_precalculation):
+    logging.warning(
+        "The first layer precalculation is disabled, so the first layer"
+        " product with the adjacency is computed in every step. Set"
+        " `model.first_layer_precalculation` to compute it once when"
+        " preprocessing the dataset instead.")
 
 # Decide on the dtype of the adjacency matrix
 adjacency_dtype_training = get_adjacency_dtype(
     config.training.device,
-    config.training.use_sparse_representation)
+    config.training.use_sparse_representation,
+    config.model.adjacency.precompute_normalisation)
 
 method_max_edges = get_method_max(config.method_max_edges)
 method_max_nodes = get_method_max(config.method_max_nodes)
@@ -268,9 +280,17 @@ num_real_nodes_per_epoch = len(dataset.dataset_splits["train"])
 
 Create a efficient dataset generator for training using the TensorFlow `tf.data.Dataset` API. This allows preprocessing the data with multiple threads, increasing the speed at which the host can feed data to the Graphcore IPU. This is important, as the Graphcore IPU is so fast for GNN, that the host is usually the bottleneck!
 """
+# Edges are fed with the narrowest index dtype that fits the batch.
+adjacency_indices_dtype_training = get_adjacency_indices_dtype(
+    adjacency_form_training,
+    training_clusters.max_nodes_per_batch)
+
+# The generator is not deterministic by default, which lets batches be
+# produced out of order by the parallel calls to keep the IPU fed.
 data_generator_training = tf_dataset_generator(
     adjacency=dataset.adjacency_train,
-    clusters=training_clusters.clusters,
+    cluster_nodes=training_clusters.cluster_nodes,
+    cluster_offsets=training_clusters.cluster_offsets,
     features=dataset.features_train,
     labels=dataset.labels,
     mask=dataset.mask_train,
@@ -280,11 +300,13 @@ data_generator_training = tf_dataset_generator(
     max_edges_per_batch=training_clusters.max_edges_per_batch,
     adjacency_dtype=adjacency_dtype_training,
     adjacency_form=adjacency_form_training,
+    adjacency_indices_dtype=adjacency_indices_dtype_training,
     micro_batch_size=config.training.micro_batch_size,
     seed=config.seed,
     prefetch_depth=config.training.dataset_prefetch_depth,
     distributed_worker_count=popdist.getNumInstances(),
-    distributed_worker_index=popdist.getInstanceIndex()
+    distributed_worker_index=popdist.getInstanceIndex(),
+    normalise_adjacency=config.model.adjacency.precompute_normalisation
 )
 logging.info(
     f"Created batch generator for training: {data_generator_training}")
@@ -331,6 +353,11 @@ num_pipeline_stages_training = len(
 num_ipus_per_replica_training = max(
     config.training.ipu_config.pipeline_device_mapping) + 1
 
+# Cache the compiled executables, so that rerunning with the same
+# shapes, for example for the test model, loads them instead of compiling.
+if config.executable_cache_path:
+    set_executable_cache_path(config.executable_cache_path)
+
 # Create a strategy scope for training
 strategy_training_scope = create_ipu_strategy(
     num_ipus_per_replica=num_pipeline_stages_training,
@@ -351,7 +378,7 @@ Create, compile and train the model within the desired strategy scope.
 # Seed the random generators for reproducibility
 set_random_seeds(config.seed)
 
-with strategy_training_scope:
+with strategy_training_scope, precision.policy_scope():
     # Create the model for training
     model_training = create_model(
         micro_batch_size=config.training.micro_batch_size,
@@ -364,15 +391,24 @@ with strategy_training_scope:
         dropout_rate=config.model.dropout,
         adjacency_params=config.model.adjacency.dict(),
         cast_model_inputs_to_dtype=precision.cast_model_inputs_to_dtype,
+        features_dtype=precision.features_precision,
         first_layer_precalculation=config.model.first_layer_precalculation,
         use_ipu_layers=(config.training.device == "ipu"),
-        adjacency_form=adjacency_form_training
+        adjacency_form=adjacency_form_training,
+        adjacency_indices_dtype=tf.as_dtype(adjacency_indices_dtype_training)
     )
     model_training.summary(print_fn=logging.info)
 
     # Set options for the infeed and outfeed buffers that connect IPU and host.
-    model_training.set_infeed_queue_options(prefetch_depth=10)
-    model_training.set_outfeed_queue_options(buffer_depth=10)
+    # Size them to the number of steps run per execution so the IPU is not
+    # starved by the infeed or blocked on the outfeed.
+    feed_queue_depth = get_feed_queue_depth(batch_config_training.steps_per_execution)
+    # Staging batches ahead in the infeed lets the I/O tiles transfer the
+    # next batch while the current step is running.
+    infeed_prefetch_depth = (config.training.ipu_config.infeed_prefetch_depth
+                             or feed_queue_depth)
+    model_training.set_infeed_queue_options(prefetch_depth=infeed_prefetch_depth)
+    model_training.set_outfeed_queue_options(buffer_depth=feed_queue_depth)
 
     if num_pipeline_stages_training > 1 and config.training.device == "ipu":
         # Pipeline the model if required
@@ -404,7 +440,8 @@ with strategy_training_scope:
         num_replicas=config.training.replicas,
         learning_rate=tf.cast(config.training.lr, dtype=tf.float32),
         loss_scaling=config.training.loss_scaling,
-        optimizer_compute_precision=precision.optimizer_compute_precision
+        optimizer_compute_precision=precision.optimizer_compute_precision,
+        use_ipu_optimizer=(config.training.device == "ipu")
     )
 
     # Compile the model
@@ -453,19 +490,19 @@ Note we usually have different requirements for testing than training. For examp
 
 Here, again, we use the values from the config file.
 """
-# Set the precision policy for testing
+# Precision for testing, its policy is applied to the test model
 precision = Precision(config.test.precision)
-tf.keras.mixed_precision.set_global_policy(precision.policy)
 
 # Set how the adjacency matrix is expressed,
-# namely dense tensor, sparse tensor, or tuple.
+# namely dense tensor or tuple.
 adjacency_form_test = get_adjacency_form(
     config.test.device,
     config.test.use_sparse_representation)
 # Decide on the dtype of the adjacency matrix
 adjacency_dtype_test = get_adjacency_dtype(
     config.test.device,
-    config.test.use_sparse_representation)
+    config.test.use_sparse_representation,
+    config.model.adjacency.precompute_normalisation)
 
 """
 ### Cluster test dataset
@@ -494,7 +531,12 @@ test_clusters = ClusterGraph(
     inter_cluster_ratio=config.inter_cluster_ratio,
     method_max_nodes=method_max_nodes,
     method_max_edges=method_max_edges,
-    node_edge_imbalance_ratio=config.cluster_node_edge_imbalance_ratio
+    node_edge_imbalance_ratio=config.cluster_node_edge_imbalance_ratio,
+    # The training clustering is extended to the full graph instead of
+    # clustering it again, when both use the same number of clusters.
+    base_partition=(training_clusters
+                    if config.test.num_clusters == training_clusters.num_clusters
+                    else None)
 )
 test_clusters.cluster_graph()
 
@@ -503,9 +545,15 @@ test_clusters.cluster_graph()
 
 Create an efficient dataset generator that can feed the Keras Model.evaluate method.
 """
+# Edges are fed with the narrowest index dtype that fits the batch.
+adjacency_indices_dtype_test = get_adjacency_indices_dtype(
+    adjacency_form_test,
+    test_clusters.max_nodes_per_batch)
+
 data_generator_test = tf_dataset_generator(
     adjacency=dataset.adjacency_full,
-    clusters=test_clusters.clusters,
+    cluster_nodes=test_clusters.cluster_nodes,
+    cluster_offsets=test_clusters.cluster_offsets,
     features=dataset.features,
     labels=dataset.labels,
     mask=dataset.mask_test,
@@ -515,8 +563,14 @@ data_generator_test = tf_dataset_generator(
     max_edges_per_batch=test_clusters.max_edges_per_batch,
     adjacency_dtype=adjacency_dtype_test,
     adjacency_form=adjacency_form_test,
+    adjacency_indices_dtype=adjacency_indices_dtype_test,
     micro_batch_size=config.test.micro_batch_size,
-    seed=config.seed
+    seed=config.seed,
+    prefetch_depth=config.test.dataset_prefetch_depth,
+    cache_dataset=True,
+    snapshot_dir=config.evaluation_snapshot_path,
+    regenerate_snapshot=config.regenerate_dataset_cache,
+    normalise_adjacency=config.model.adjacency.precompute_normalisation
 )
 logging.info(
     f"Created batch generator for test: {data_generator_test}")
@@ -534,21 +588,24 @@ Create the model for test that will run on the CPU.
 """
 set_random_seeds(config.seed + 1)
 
-model_test = create_model(
-    micro_batch_size=config.test.micro_batch_size,
-    num_labels=dataset.num_labels,
-    num_features=dataset.num_features,
-    max_nodes_per_batch=test_clusters.max_nodes_per_batch,
-    max_edges_per_batch=test_clusters.max_edges_per_batch,
-    hidden_size=config.model.hidden_size,
-    num_layers=config.model.num_layers,
-    dropout_rate=config.model.dropout,
-    adjacency_params=config.model.adjacency.dict(),
-    cast_model_inputs_to_dtype=precision.cast_model_inputs_to_dtype,
-    first_layer_precalculation=config.model.first_layer_precalculation,
-    use_ipu_layers=(config.test.device == "ipu"),
-    adjacency_form=adjacency_form_test
-)
+with precision.policy_scope():
+    model_test = create_model(
+        micro_batch_size=config.test.micro_batch_size,
+        num_labels=dataset.num_labels,
+        num_features=dataset.num_features,
+        max_nodes_per_batch=test_clusters.max_nodes_per_batch,
+        max_edges_per_batch=test_clusters.max_edges_per_batch,
+        hidden_size=config.model.hidden_size,
+        num_layers=config.model.num_layers,
+        dropout_rate=config.model.dropout,
+        adjacency_params=config.model.adjacency.dict(),
+        cast_model_inputs_to_dtype=precision.cast_model_inputs_to_dtype,
+        features_dtype=precision.features_precision,
+        first_layer_precalculation=config.model.first_layer_precalculation,
+        use_ipu_layers=(config.test.device == "ipu"),
+        adjacency_form=adjacency_form_test,
+        adjacency_indices_dtype=tf.as_dtype(adjacency_indices_dtype_test)
+    )
 
 """
 Copy the weights from training.
@@ -15,7 +15,7 @@ from model.precision import Precision
 from utilities.argparser import add_arguments, combine_config_file_with_args
 from utilities.constants import GraphType
 from utilities.options import Options
-from utilities.utils import get_adjacency_dtype, get_adjacency_form, get_method_max
+from utilities.utils import get_adjacency_dtype, get_adjacency_form, get_adjacency_indices_dtype, get_method_max
 
 
 def estimate_ds_throughput(config):
@@ -32,7 +32,8 @@ def estimate_ds_throughput(config):
     # Decide on the dtype of the adjacency matrix
     adjacency_dtype_training = get_adjacency_dtype(
         config.training.device,
-        config.training.use_sparse_representation)
+        config.training.use_sparse_representation,
+        config.model.adjacency.precompute_normalisation)
 
     method_max_edges = get_method_max(config.method_max_edges)
     method_max_nodes = get_method_max(config.method_max_nodes)
@@ -69,7 +70,8 @@ def estimate_ds_throughput(config):
     # Create dataset generators for training
     data_generator_training = tf_dataset_generator(
         adjacency=dataset.adjacency_train,
-        clusters=training_clusters.clusters,
+        cluster_nodes=training_clusters.cluster_nodes,
+        cluster_offsets=training_clusters.cluster_offsets,
         features=dataset.features_train,
         labels=dataset.labels,
         mask=dataset.mask_train,
@@ -79,7 +81,11 @@ def estimate_ds_throughput(config):
         max_edges_per_batch=training_clusters.max_edges_per_batch,
         adjacency_dtype=adjacency_dtype_training,
         adjacency_form=adjacency_form_training,
-        seed=config.seed
+        adjacency_indices_dtype=get_adjacency_indices_dtype(
+            adjacency_form_training, training_clusters.max_nodes_per_batch),
+        seed=config.seed,
+        prefetch_depth=config.training.dataset_prefetch_depth,
+        normalise_adjacency=config.model.adjacency.precompute_normalisation
     )
 
     results_tfdatatype = dataset_benchmark(data_generator_training, config.training.epochs, elements_per_epochs = int(config.training.num_clusters / config.training.clusters_per_batch), print_stats=False)
@@ -28,6 +28,13 @@ ADJACENCY_FORMS = [AdjacencyForm.DENSE, AdjacencyForm.SPARSE_TENSOR, AdjacencyFo
                       [1., 0.001, 0.],
                       [1., 0., 0.001]], dtype=np.float32)
     ),
+    (
+            dict(transform_mode="normalised_regularised", regularisation=0.001,
+                 precompute_normalisation=True),
+            np.array([[0.001, 1., 1.],
+                      [1., 0.001, 0.],
+                      [1., 0., 0.001]], dtype=np.float32)
+    ),
 
     (
         dict(transform_mode="self_connections_scaled_by_degree"),
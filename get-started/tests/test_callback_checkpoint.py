@@ -1,7 +1,6 @@
 # Copyright (c) 2022 Graphcore Ltd. All rights reserved.
 import inspect
-from datetime import datetime
-from glob import glob
+import os
 from pathlib import Path
 from tempfile import TemporaryDirectory
 
@@ -15,8 +14,8 @@ class TestCheckpointCallbacks:
 
     def test_checkpoint_creation(self):
         with TemporaryDirectory() as temp_dir:
-            checkpoint_name = (f"{inspect.currentframe().f_code.co_name}"
-                               f"_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+            # The temporary directory is already unique to this run.
+            checkpoint_name = inspect.currentframe().f_code.co_name
             checkpoint_dir = Path(temp_dir).joinpath(checkpoint_name).joinpath("test")
 
             micro_batch_size = 4
@@ -52,7 +51,8 @@ class TestCheckpointCallbacks:
                           epochs=1,
                           callbacks=callback)
 
-            checkpoint_files = glob(str(checkpoint_dir.joinpath("*.h5")))
+            checkpoint_files = [entry.name for entry in os.scandir(checkpoint_dir)
+                                if entry.name.endswith(".h5")]
 
             print(checkpoint_files)
 
@@ -1,11 +1,14 @@
 # Copyright (c) 2022 Graphcore Ltd. All rights reserved.
 
+import hashlib
 import math
+from unittest import mock
 
 import numpy as np
 import pytest
+import scipy.sparse as sp
 
-from data_utils.clustering_utils import ClusterGraph
+from data_utils.clustering_utils import ClusterGraph, get_cluster_node_ordering
 from utilities.constants import AdjacencyForm
 from tests.utils import edge_list_to_sparse_adj
 
@@ -244,3 +247,163 @@ def test_cluster_graph_cache_no_file():
     for x, y in zip(graph_clusters._clusters, original_clusters):
         # Hasn't loaded from the file (data change means we can test this)
         assert not np.array_equal(x, y)
+
+
+def test_get_cluster_node_ordering():
+    clusters = [np.array([4, 1]), np.array([], dtype=np.int32), np.array([0, 3, 2])]
+    cluster_nodes, cluster_offsets = get_cluster_node_ordering(clusters)
+    np.testing.assert_array_equal(cluster_nodes, [4, 1, 0, 3, 2])
+    np.testing.assert_array_equal(cluster_offsets, [0, 2, 2, 5])
+    for cluster_idx, cluster in enumerate(clusters):
+        np.testing.assert_array_equal(
+            cluster_nodes[cluster_offsets[cluster_idx]:cluster_offsets[cluster_idx + 1]],
+            cluster)
+
+
+@pytest.mark.parametrize("directed_graph", [True, False])
+def test_cluster_graph_with_base_partition(directed_graph):
+    edge_list = np.array([[0, 1],
+                          [2, 3],
+                          [1, 4],
+                          [4, 5],
+                          [3, 6]])
+    if not directed_graph:
+        edge_list = np.concatenate((edge_list, edge_list[:, ::-1]))
+    num_nodes = 8
+    adj = edge_list_to_sparse_adj(edge_list, num_nodes)
+
+    base_clusters = ClusterGraph(adjacency=adj,
+                                 clusters_per_batch=1,
+                                 visible_nodes=np.array([0, 1, 2, 3]),
+                                 num_clusters=2,
+                                 directed_graph=directed_graph)
+    base_clusters._clusters = [np.array([0, 1], dtype=np.int32),
+                               np.array([2, 3], dtype=np.int32)]
+
+    graph_clusters = ClusterGraph(adjacency=adj,
+                                  clusters_per_batch=1,
+                                  visible_nodes=np.arange(num_nodes),
+                                  num_clusters=2,
+                                  directed_graph=directed_graph,
+                                  base_partition=base_clusters)
+    graph_clusters.cluster_graph()
+
+    # Nodes 4 and 5 are reached from the first cluster and node 6 from
+    # the second one. Node 7 is isolated so it is assigned evenly.
+    np.testing.assert_array_equal(graph_clusters.clusters[0], [0, 1, 4, 5, 7])
+    np.testing.assert_array_equal(graph_clusters.clusters[1], [2, 3, 6])
+
+
+def test_cluster_graph_with_base_partition_different_num_clusters():
+    adj = edge_list_to_sparse_adj(np.array([[0, 1]]), 2)
+    base_clusters = ClusterGraph(adjacency=adj,
+                                 clusters_per_batch=1,
+                                 visible_nodes=np.arange(2),
+                                 num_clusters=2)
+    with pytest.raises(ValueError):
+        ClusterGraph(adjacency=adj,
+                     clusters_per_batch=1,
+                     visible_nodes=np.arange(2),
+                     num_clusters=1,
+                     base_partition=base_clusters)
+
+
+def test_cluster_graph_cache_is_memory_mapped(tmp_path):
+    edge_list = np.array([[0, 4],
+                          [0, 3],
+                          [0, 1],
+                          [3, 4],
+                          [1, 2],
+                          [1, 5],
+                          [2, 4],
+                          [4, 6],
+                          [3, 6]])
+    num_nodes = 7
+    adj = edge_list_to_sparse_adj(edge_list, num_nodes)
+    graph_clusters = ClusterGraph(adjacency=adj,
+                                  clusters_per_batch=2,
+                                  visible_nodes=range(num_nodes),
+                                  num_clusters=3,
+                                  dataset_name="test_clusters_mmap",
+                                  cache_dir=tmp_path,
+                                  directed_graph=True,
+                                  adjacency_form=AdjacencyForm.DENSE)
+    graph_clusters.cluster_graph()
+    original_clusters = graph_clusters.clusters
+
+    graph_clusters._clusters = None
+    graph_clusters.regenerate_cluster_cache = False
+    graph_clusters.cluster_graph()
+
+    assert len(graph_clusters.clusters) == len(original_clusters)
+    for x, y in zip(graph_clusters.clusters, original_clusters):
+        np.testing.assert_equal(x, y)
+        assert isinstance(x, np.memmap)
+    # The batch generator reads the memory mapped nodes without a copy.
+    assert isinstance(graph_clusters.cluster_nodes, np.memmap)
+
+
+def test_cluster_graph_cache_depends_on_edges(tmp_path):
+    edge_list = np.array([[0, 4],
+                          [0, 3],
+                          [0, 1],
+                          [3, 4],
+                          [1, 2],
+                          [1, 5],
+                          [2, 4],
+                          [4, 6],
+                          [3, 6]])
+    # The same number of nodes and edges, with one edge moved.
+    changed_edge_list = edge_list.copy()
+    changed_edge_list[-1] = [5, 6]
+    num_nodes = 7
+    graph_clusters = [
+        ClusterGraph(adjacency=edge_list_to_sparse_adj(edges, num_nodes),
+                     clusters_per_batch=2,
+                     visible_nodes=range(num_nodes),
+                     num_clusters=3,
+                     dataset_name="test_clusters_edges",
+                     cache_dir=tmp_path,
+                     directed_graph=True,
+                     adjacency_form=AdjacencyForm.DENSE)
+        for edges in (edge_list, changed_edge_list)
+    ]
+    graph_clusters[0].cluster_graph()
+
+    assert (graph_clusters[0].unique_identifier !=
+            graph_clusters[1].unique_identifier)
+    assert not graph_clusters[1].load()
+
+
+def test_cluster_graph_fingerprint_is_computed_once(tmp_path):
+    edge_list = np.array([[0, 1], [1, 2], [2, 3], [3, 0]])
+    num_nodes = 4
+    graph_clusters = ClusterGraph(adjacency=edge_list_to_sparse_adj(edge_list, num_nodes),
+                                  clusters_per_batch=1,
+                                  visible_nodes=range(num_nodes),
+                                  num_clusters=2,
+                                  dataset_name="test_clusters_fingerprint",
+                                  cache_dir=tmp_path)
+    with mock.patch.object(hashlib, "sha1", wraps=hashlib.sha1) as sha1:
+        identifiers = {graph_clusters.unique_identifier for _ in range(3)}
+        graph_clusters.cluster_graph()
+        graph_clusters.load()
+
+    assert len(identifiers) == 1
+    assert sha1.call_count == 1
+
+
+def test_cluster_graph_converts_adjacency_to_csr():
+    edge_list = np.array([[2, 1], [0, 2], [2, 0], [0, 1], [2, 1]])
+    adj = sp.coo_matrix(
+        (np.ones(edge_list.shape[0], dtype=np.float32),
+         (edge_list[:, 0], edge_list[:, 1])),
+        shape=(3, 3))
+    graph_clusters = ClusterGraph(adjacency=adj,
+                                  clusters_per_batch=1,
+                                  visible_nodes=range(3),
+                                  num_clusters=1)
+
+    assert sp.isspmatrix_csr(graph_clusters.adjacency)
+    assert graph_clusters.adjacency.has_canonical_format
+    np.testing.assert_equal(graph_clusters.adjacency.toarray(), adj.toarray())
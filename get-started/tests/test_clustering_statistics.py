@@ -68,3 +68,18 @@ def test_clustering_statistics():
     clustering_statistics.build_nx_graph_from_edge_list(clustering_statistics.adjacency_coo[0])
     full_graph_degrees = clustering_statistics.get_graph_degrees(clustering_statistics.full_graph)
     assert full_graph_degrees == [3, 2, 2, 2, 1]
+
+
+def test_get_sparsity_ratio_for_clusters():
+    adjacency = get_example_adjacency()
+    # The last clusters overlap the first ones, as combined clusters do.
+    clusters = [np.array([1, 2]), np.array([0, 3, 4]), np.array([], dtype=np.int64),
+                np.array([0, 1, 2]), np.array([3, 4, 0])]
+
+    sparsity_ratios = ClusteringStatistics.get_sparsity_ratio_for_clusters(
+        adjacency, clusters)
+
+    expected_sparsity_ratios = [
+        ClusteringStatistics.get_sparsity_ratio(adjacency[cluster, :][:, cluster])
+        for cluster in clusters]
+    np.testing.assert_array_almost_equal(sparsity_ratios, expected_sparsity_ratios)
@@ -1,12 +1,19 @@
 # Copyright (c) 2022 Graphcore Ltd. All rights reserved.
+import logging
+
 import tensorflow as tf
 import numpy as np
 import pytest
 import scipy.sparse as sp
 import tensorflow as tf
 
+from data_utils.clustering_utils import get_cluster_node_ordering
 from data_utils.dataset_batch_generator import (
+    TENSOR_ALIGNMENT_BYTES,
     add_self_edges_with_dummy_values,
+    empty_aligned,
+    get_batches_fingerprint,
+    get_narrowest_labels_dtype,
     pad_adjacency_tuple,
     tf_dataset_generator
 )
@@ -50,13 +57,65 @@ def test_pad_adjacency_tuple():
     np.testing.assert_equal(values, expected_values)
 
 
+def test_pad_adjacency_tuple_clipped_keeps_csr_order():
+    edges = np.array([[0, 1], [1, 0], [1, 2], [2, 1], [2, 3]])
+    max_num_nodes = 5
+    max_num_edges = 6
+    adjacency = sp.csr_matrix(
+        (
+            np.ones((edges.shape[0]), dtype=np.float32),
+            (edges[:, 0], edges[:, 1])
+        ),
+        shape=(max_num_nodes, max_num_nodes)
+    )
+    adjacency = add_self_edges_with_dummy_values(adjacency)
+    indices, values = pad_adjacency_tuple(
+        adjacency, np.bool, max_num_edges, max_num_nodes)
+    assert indices.shape == (max_num_edges, 2)
+    assert values.shape == (max_num_edges,)
+    assert np.all(np.diff(indices[:, 0]) >= 0)
+
+
+def test_pad_adjacency_tuple_indices_dtype():
+    max_num_nodes = 3
+    adjacency = sp.csr_matrix(
+        (np.ones(2, dtype=np.float32), ([0, 1], [1, 0])),
+        shape=(max_num_nodes, max_num_nodes)
+    )
+    adjacency = add_self_edges_with_dummy_values(adjacency)
+    indices, _ = pad_adjacency_tuple(
+        adjacency, np.bool, 6, max_num_nodes, indices_dtype=np.uint16)
+    assert indices.dtype == np.uint16
+    np.testing.assert_equal(indices[-1], [2, 2])
+
+
+@pytest.mark.parametrize("dtype", [np.bool_, np.float16, np.int32])
+@pytest.mark.parametrize("shape", [(1,), (7, 3), (2, 1, 5)])
+def test_empty_aligned(dtype, shape):
+    array = empty_aligned(shape, dtype)
+    assert array.shape == shape
+    assert array.dtype == dtype
+    assert array.flags.c_contiguous
+    assert array.ctypes.data % TENSOR_ALIGNMENT_BYTES == 0
+
+
+@pytest.mark.parametrize(
+    "labels,expected_dtype",
+    [(np.array([[0, 1], [1, 0]], dtype=np.int32), np.int8),
+     (np.array([[46], [3]], dtype=np.int64), np.int8),
+     (np.array([[348], [0]], dtype=np.int32), np.int16),
+     (np.array([[70000]], dtype=np.int64), np.int32),
+     (np.array([[0.5]], dtype=np.float32), np.float32)])
+def test_get_narrowest_labels_dtype(labels, expected_dtype):
+    assert get_narrowest_labels_dtype(labels) == expected_dtype
+
+
 @pytest.mark.parametrize("features_dtype", [np.float16, np.float32])
 @pytest.mark.parametrize("labels_dtype", [np.int32])
 @pytest.mark.parametrize(
     "adjacency_form",
     [
         AdjacencyForm.DENSE,
-        AdjacencyForm.SPARSE_TENSOR,
         AdjacencyForm.SPARSE_TUPLE
     ]
 )
@@ -122,9 +181,12 @@ def test_tf_dataset_generator(features_dtype,
         shape=(max_nodes_per_batch, max_nodes_per_batch)
     )
 
+    cluster_nodes, cluster_offsets = get_cluster_node_ordering(clusters)
+
     dataset_generator = tf_dataset_generator(
         adjacency,
-        clusters,
+        cluster_nodes,
+        cluster_offsets,
         features,
         labels,
         mask,
@@ -148,6 +210,10 @@ def test_tf_dataset_generator(features_dtype,
 
     if adjacency_form == AdjacencyForm.SPARSE_TUPLE:
         assert first_batch[0]["adjacency_batch"][1].dtype == adjacency_dtype
+        # The edges, including the padding, are grouped by the row they
+        # are aggregated into.
+        edge_rows = np.asarray(first_batch[0]["adjacency_batch"][0])[0, :, 0]
+        assert np.all(np.diff(edge_rows) >= 0)
         # Remove fake node.
         features = first_batch[0]["features_batch"][0][:-1]
         labels = first_batch[1][0][:-1]
@@ -161,4 +227,209 @@ def test_tf_dataset_generator(features_dtype,
     assert features.dtype == features_dtype
 
     np.testing.assert_array_equal(labels, expected_labels)
-    assert labels.dtype == labels_dtype
+    # The labels are narrowed to the smallest dtype that holds them.
+    assert labels.dtype == np.int8
+
+
+def test_tf_dataset_generator_cache_dataset():
+    clusters = [np.array([0, 1]), np.array([2])]
+    max_nodes_per_batch = 3
+    labels = np.array([[0], [1], [2]], dtype=np.int32)
+    mask = np.array([1, 1, 1])
+    features = np.array([[0.0], [0.1], [0.2]], dtype=np.float32)
+    adjacency = sp.csr_matrix(
+        (np.ones(2, dtype=np.float32), ([0, 1], [1, 0])),
+        shape=(max_nodes_per_batch, max_nodes_per_batch)
+    )
+
+    cluster_nodes, cluster_offsets = get_cluster_node_ordering(clusters)
+
+    dataset_generator = tf_dataset_generator(
+        adjacency,
+        cluster_nodes,
+        cluster_offsets,
+        features,
+        labels,
+        mask,
+        num_clusters=2,
+        clusters_per_batch=1,
+        max_nodes_per_batch=max_nodes_per_batch,
+        max_edges_per_batch=4,
+        adjacency_dtype=np.float32,
+        adjacency_form=AdjacencyForm.DENSE,
+        seed=3,
+        deterministic=True,
+        cache_dataset=True
+    )
+
+    # Without shuffling, each pass over the cached dataset
+    # yields the clusters in the same order.
+    batches = list(dataset_generator.take(4))
+    for first_pass, second_pass in zip(batches[:2], batches[2:]):
+        np.testing.assert_array_equal(first_pass[0]["features_batch"],
+                                      second_pass[0]["features_batch"])
+        np.testing.assert_array_equal(first_pass[1], second_pass[1])
+    np.testing.assert_array_equal(batches[0][1], [[0], [1], [-1]])
+    np.testing.assert_array_equal(batches[1][1], [[2], [-1], [-1]])
+
+
+def test_get_batches_fingerprint():
+    arrays = (np.arange(4, dtype=np.int32), np.array([[0], [1]], dtype=np.int8))
+    params = (3, "DENSE")
+    fingerprint = get_batches_fingerprint(arrays, params)
+
+    assert fingerprint == get_batches_fingerprint(
+        tuple(array.copy() for array in arrays), params)
+    assert fingerprint != get_batches_fingerprint(arrays, (4, "DENSE"))
+    assert fingerprint != get_batches_fingerprint(
+        (arrays[0][::-1], arrays[1]), params)
+    assert fingerprint != get_batches_fingerprint(
+        (arrays[0].astype(np.int64), arrays[1]), params)
+
+
+def test_tf_dataset_generator_snapshot_requires_cache_dataset(tmp_path):
+    cluster_nodes, cluster_offsets = get_cluster_node_ordering([np.array([0, 1])])
+    with pytest.raises(ValueError):
+        tf_dataset_generator(
+            sp.eye(2, format="csr", dtype=np.float32),
+            cluster_nodes,
+            cluster_offsets,
+            np.zeros((2, 1), dtype=np.float32),
+            np.zeros((2, 1), dtype=np.int32),
+            np.ones(2),
+            num_clusters=1,
+            clusters_per_batch=1,
+            max_nodes_per_batch=2,
+            max_edges_per_batch=2,
+            adjacency_dtype=np.float32,
+            adjacency_form=AdjacencyForm.DENSE,
+            snapshot_dir=tmp_path
+        )
+
+
+def test_tf_dataset_generator_snapshot_depends_on_features(tmp_path, caplog):
+    caplog.set_level(logging.INFO)
+    cluster_nodes, cluster_offsets = get_cluster_node_ordering([np.array([0, 1])])
+    features = np.array([[0.0], [0.1]], dtype=np.float32)
+    changed_features = np.array([[0.0], [0.2]], dtype=np.float32)
+    for features_batch in (features, features.copy(), changed_features):
+        tf_dataset_generator(
+            sp.eye(2, format="csr", dtype=np.float32),
+            cluster_nodes,
+            cluster_offsets,
+            features_batch,
+            np.zeros((2, 1), dtype=np.int32),
+            np.ones(2),
+            num_clusters=1,
+            clusters_per_batch=1,
+            max_nodes_per_batch=2,
+            max_edges_per_batch=2,
+            adjacency_dtype=np.float32,
+            adjacency_form=AdjacencyForm.DENSE,
+            cache_dataset=True,
+            snapshot_dir=tmp_path
+        )
+
+    snapshot_paths = [record.getMessage() for record in caplog.records
+                      if record.getMessage().startswith("Using the snapshot")]
+    assert len(snapshot_paths) == 3
+    assert snapshot_paths[0] == snapshot_paths[1]
+    assert snapshot_paths[0] != snapshot_paths[2]
+
+
+@pytest.mark.parametrize("worker_count,worker_index", [(2, 2), (2, -1), (3, 0)])
+def test_tf_dataset_generator_invalid_distributed_worker(worker_count, worker_index):
+    cluster_nodes, cluster_offsets = get_cluster_node_ordering(
+        [np.array([0]), np.array([1])])
+    with pytest.raises(ValueError):
+        tf_dataset_generator(
+            sp.eye(2, format="csr", dtype=np.float32),
+            cluster_nodes,
+            cluster_offsets,
+            np.zeros((2, 1), dtype=np.float32),
+            np.zeros((2, 1), dtype=np.int32),
+            np.ones(2),
+            num_clusters=2,
+            clusters_per_batch=1,
+            max_nodes_per_batch=2,
+            max_edges_per_batch=2,
+            adjacency_dtype=np.float32,
+            adjacency_form=AdjacencyForm.DENSE,
+            distributed_worker_count=worker_count,
+            distributed_worker_index=worker_index
+        )
+
+
+@pytest.mark.parametrize("adjacency_form", [AdjacencyForm.DENSE,
+                                            AdjacencyForm.SPARSE_TUPLE])
+def test_tf_dataset_generator_normalise_adjacency(adjacency_form):
+    clusters = [np.array([0, 1, 2]), np.array([3])]
+    max_nodes_per_batch = 4
+    labels = np.array([[0], [1], [2], [3]], dtype=np.int32)
+    mask = np.array([1, 1, 1, 1])
+    features = np.zeros((4, 1), dtype=np.float32)
+    # Node 0 has an edge to node 3, in another cluster, which
+    # doesn't count towards its degree in the batch.
+    edges = np.array([[0, 1], [0, 2], [0, 3], [1, 0], [2, 0], [2, 1]])
+    expected_adj_matrix = np.zeros((max_nodes_per_batch, max_nodes_per_batch),
+                                   dtype=np.float32)
+    expected_adj_matrix[0, [1, 2]] = 0.5
+    expected_adj_matrix[1, 0] = 1.0
+    expected_adj_matrix[2, [0, 1]] = 0.5
+
+    # Add fake node if needed
+    if adjacency_form == AdjacencyForm.SPARSE_TUPLE:
+        max_nodes_per_batch += 1
+    adjacency = sp.csr_matrix(
+        (np.ones(edges.shape[0], dtype=np.float32), (edges[:, 0], edges[:, 1])),
+        shape=(max_nodes_per_batch, max_nodes_per_batch)
+    )
+
+    cluster_nodes, cluster_offsets = get_cluster_node_ordering(clusters)
+
+    dataset_generator = tf_dataset_generator(
+        adjacency,
+        cluster_nodes,
+        cluster_offsets,
+        features,
+        labels,
+        mask,
+        num_clusters=2,
+        clusters_per_batch=1,
+        max_nodes_per_batch=max_nodes_per_batch,
+        max_edges_per_batch=12,
+        adjacency_dtype=np.float32,
+        adjacency_form=adjacency_form,
+        deterministic=True,
+        cache_dataset=True,
+        normalise_adjacency=True
+    )
+
+    first_batch = iter(dataset_generator.take(1)).next()
+
+    assert_equal_adjacency(
+        first_batch[0]["adjacency_batch"],
+        sp.coo_matrix(expected_adj_matrix),
+        adjacency_form
+    )
+
+
+def test_tf_dataset_generator_normalise_bool_adjacency():
+    adjacency = sp.csr_matrix(np.eye(2, k=1, dtype=bool))
+    cluster_nodes, cluster_offsets = get_cluster_node_ordering([np.array([0, 1])])
+    with pytest.raises(ValueError):
+        tf_dataset_generator(
+            adjacency,
+            cluster_nodes,
+            cluster_offsets,
+            np.zeros((2, 1), dtype=np.float32),
+            np.zeros((2, 1), dtype=np.int32),
+            np.ones(2),
+            num_clusters=1,
+            clusters_per_batch=1,
+            max_nodes_per_batch=2,
+            max_edges_per_batch=2,
+            adjacency_dtype=bool,
+            adjacency_form=AdjacencyForm.DENSE,
+            normalise_adjacency=True
+        )
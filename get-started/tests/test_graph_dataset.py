@@ -6,7 +6,7 @@ import numpy as np
 import pytest
 import scipy.sparse as sp
 
-from data_utils.dataset_loader import GraphDataset, HeterogeneousGraphDataset
+from data_utils.dataset_loader import GraphDataset, HeterogeneousGraphDataset, HomogeneousGraphDataset
 from utilities.constants import MASKED_LABEL_VALUE, GraphType, Task
 
 
@@ -198,6 +198,144 @@ def test_generate_train_features(in_data_dtype):
     assert train_features.dtype == in_data_dtype
 
 
+def test_save_and_load_preprocessed_dataset(tmp_path):
+    features = np.arange(12, dtype=np.float32).reshape(4, 3)
+    dataset = HomogeneousGraphDataset(
+        dataset_name="test",
+        total_num_nodes=4,
+        edges=np.array([[0, 1], [1, 2], [2, 3]]),
+        features=features,
+        labels=np.arange(4).reshape(4, 1),
+        dataset_splits={"train": np.array([0, 1]),
+                        "validation": np.array([2]),
+                        "test": np.array([3])},
+        task=Task.MULTI_CLASS_CLASSIFICATION,
+        graph_type=GraphType.UNDIRECTED,
+    )
+    file_path = tmp_path.joinpath("test_preprocessed.pickle.gz")
+    dataset.save(file_path)
+
+    assert tmp_path.joinpath("test_preprocessed_features.npy").is_file()
+    assert tmp_path.joinpath("test_preprocessed_features_train.npy").is_file()
+    loaded_dataset = GraphDataset.load_preprocessed_dataset(file_path)
+    assert isinstance(loaded_dataset.features, np.memmap)
+    assert isinstance(loaded_dataset.features_train, np.memmap)
+    np.testing.assert_array_equal(loaded_dataset.features_train, dataset.features_train)
+    np.testing.assert_array_equal(loaded_dataset.features, features)
+
+
+def test_save_and_load_preprocessed_dataset_shared_features(tmp_path):
+    features = np.arange(12, dtype=np.float32).reshape(4, 3)
+    dataset = HomogeneousGraphDataset(
+        dataset_name="test",
+        total_num_nodes=4,
+        edges=np.array([[0, 1], [1, 2], [2, 3]]),
+        features=features,
+        labels=np.arange(4).reshape(4, 1),
+        dataset_splits={"train": np.array([0, 1]),
+                        "validation": np.array([2]),
+                        "test": np.array([3])},
+        task=Task.MULTI_CLASS_CLASSIFICATION,
+        graph_type=GraphType.UNDIRECTED,
+        skip_train_feats_and_edges_allocation=True,
+    )
+    file_path = tmp_path.joinpath("test_preprocessed.pickle.gz")
+    dataset.save(file_path)
+
+    # The shared features are saved once and mapped once.
+    assert not tmp_path.joinpath("test_preprocessed_features_train.npy").exists()
+    loaded_dataset = GraphDataset.load_preprocessed_dataset(file_path)
+    assert isinstance(loaded_dataset.features, np.memmap)
+    assert loaded_dataset.features_train is loaded_dataset.features
+    np.testing.assert_array_equal(loaded_dataset.features, features)
+
+
+@pytest.mark.parametrize("skip_train_feats_and_edges_allocation", [False, True])
+def test_save_and_load_preprocessed_mag240_dataset(tmp_path,
+                                                   skip_train_feats_and_edges_allocation):
+    features = np.arange(12, dtype=np.float32).reshape(4, 3)
+    dataset = HomogeneousGraphDataset(
+        dataset_name="test",
+        total_num_nodes=4,
+        edges=np.array([[0, 1], [1, 2], [2, 3]]),
+        features=features,
+        labels=np.arange(4).reshape(4, 1),
+        dataset_splits={"train": np.array([0, 1]),
+                        "validation": np.array([2]),
+                        "test": np.array([3])},
+        task=Task.MULTI_CLASS_CLASSIFICATION,
+        graph_type=GraphType.UNDIRECTED,
+        skip_train_feats_and_edges_allocation=skip_train_feats_and_edges_allocation,
+    )
+    base_directory = tmp_path.joinpath("test_preprocessed")
+    dataset.save_mag(base_directory)
+
+    loaded_dataset = GraphDataset.load_preprocessed_mag240_dataset(base_directory)
+    assert isinstance(loaded_dataset.features, np.memmap)
+    assert isinstance(loaded_dataset.features_train, np.memmap)
+    if skip_train_feats_and_edges_allocation:
+        assert loaded_dataset.features_train is loaded_dataset.features
+    np.testing.assert_array_equal(loaded_dataset.features_train, dataset.features_train)
+    np.testing.assert_array_equal(loaded_dataset.features, features)
+    np.testing.assert_array_equal(loaded_dataset.labels, dataset.labels)
+
+
+@pytest.mark.parametrize("skip_train_feats_and_edges_allocation", [False, True])
+def test_features_to_dtype(skip_train_feats_and_edges_allocation):
+    features = np.arange(12, dtype=np.float32).reshape(4, 3)
+    dataset = HomogeneousGraphDataset(
+        dataset_name="test",
+        total_num_nodes=4,
+        edges=np.array([[0, 1], [1, 2], [2, 3]]),
+        features=features,
+        labels=np.arange(4).reshape(4, 1),
+        dataset_splits={"train": np.array([0, 1]),
+                        "validation": np.array([2]),
+                        "test": np.array([3])},
+        task=Task.MULTI_CLASS_CLASSIFICATION,
+        graph_type=GraphType.UNDIRECTED,
+        skip_train_feats_and_edges_allocation=skip_train_feats_and_edges_allocation,
+    )
+
+    dataset.features_to_dtype(np.float16)
+
+    assert dataset.features.dtype == np.float16
+    assert dataset.features_train.dtype == np.float16
+    np.testing.assert_array_equal(dataset.features, features)
+    # Shared training features stay a single array.
+    assert ((dataset.features_train is dataset.features) ==
+            skip_train_feats_and_edges_allocation)
+
+
+@pytest.mark.parametrize("max_label, dtype, fits", [
+    (40, np.int16, True),
+    (152, np.int16, True),
+    (152, np.int8, False),
+])
+def test_labels_to_dtype(max_label, dtype, fits):
+    labels = np.array([[0], [max_label], [-1], [1]], dtype=np.int32)
+    dataset = HomogeneousGraphDataset(
+        dataset_name="test",
+        total_num_nodes=4,
+        edges=np.array([[0, 1], [1, 2], [2, 3]]),
+        features=np.zeros((4, 3), dtype=np.float32),
+        labels=labels,
+        dataset_splits={"train": np.array([0, 1]),
+                        "validation": np.array([2]),
+                        "test": np.array([3])},
+        task=Task.MULTI_CLASS_CLASSIFICATION,
+        graph_type=GraphType.UNDIRECTED,
+    )
+
+    if fits:
+        dataset.labels_to_dtype(dtype)
+        assert dataset.labels.dtype == dtype
+        np.testing.assert_array_equal(dataset.labels, labels)
+    else:
+        with pytest.raises(ValueError):
+            dataset.labels_to_dtype(dtype)
+
+
 class TestHeterogeneousGraphDataset:
 
     @classmethod
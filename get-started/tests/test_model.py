@@ -7,6 +7,7 @@ from keras.layers.core import TFOpLambda
 from keras.engine.keras_tensor import SparseKerasTensor
 
 from model.model import AdjacencyProcessing, GcnLayer, create_model
+from model.precision import Precision
 from utilities.constants import AdjacencyForm
 
 
@@ -190,3 +191,29 @@ def test_gcn_layer(adjacency_form):
 
     for i in range(len(expected_order)):
         assert order_sub_layers[i].startswith(expected_order[i])
+
+
+@pytest.mark.parametrize('adjacency_form', [AdjacencyForm.DENSE,
+                                            AdjacencyForm.SPARSE_TENSOR,
+                                            AdjacencyForm.SPARSE_TUPLE])
+@pytest.mark.parametrize('num_nodes, max_num_edges', [(4, 10), (1, 1)])
+def test_create_model_static_shapes(adjacency_form, num_nodes, max_num_edges):
+    model = create_model(1, 2, 3, num_nodes, max_num_edges, 5, 6, 0.0,
+                         {"transform_mode": "self_connections_scaled_by_degree"},
+                         adjacency_form=adjacency_form)
+    for input_tensor in tf.nest.flatten(model.inputs):
+        assert input_tensor.shape.is_fully_defined()
+    assert model.output.shape == tf.TensorShape((num_nodes, 2))
+
+
+@pytest.mark.parametrize('precision_str', ["fp16", "mixed"])
+def test_create_model_in_precision_policy_scope(precision_str):
+    precision = Precision(precision_str)
+    global_policy_name = tf.keras.mixed_precision.global_policy().name
+    with precision.policy_scope():
+        model = create_model(1, 2, 3, 4, 10, 5, 6, 0.0,
+                             {"transform_mode": "self_connections_scaled_by_degree"})
+    assert tf.keras.mixed_precision.global_policy().name == global_policy_name
+    for layer in model.layers:
+        if isinstance(layer, GcnLayer):
+            assert layer.dtype_policy.name == precision.policy.name
@@ -104,3 +104,34 @@ class TestGradientNormalization:
                           pipeline=pipeline,
                           loss_scaling=loss_scaling)
         np.testing.assert_allclose(weight, 1.9999995)
+
+
+@pytest.mark.parametrize("loss_scaling", [None, 2])
+@pytest.mark.parametrize("dtype", [tf.float32, tf.float16])
+def test_cpu_optimizer_scaling(loss_scaling, dtype):
+    optimizer = get_optimizer(
+        gradient_accumulation_steps_per_replica=2,
+        num_replicas=2,
+        learning_rate=1.0,
+        optimizer_compute_precision=tf.float32,
+        loss_scaling=loss_scaling,
+        use_ipu_optimizer=False
+    )
+    inner_optimizer = optimizer if loss_scaling is None else optimizer.inner_optimizer
+    assert type(inner_optimizer) is tf.keras.optimizers.Adam
+
+    # The gradients are unscaled and divided by the replicas and
+    # gradient accumulation steps before the update, and fed to the
+    # update in the dtype of the variable.
+    variable = tf.Variable(1.0, dtype=dtype)
+    grads_and_vars = [(tf.constant(8.0, dtype=dtype), variable)]
+    for transform in inner_optimizer.gradient_transformers:
+        grads_and_vars = transform(grads_and_vars)
+    expected_grad = 8.0 / 4 / (loss_scaling or 1)
+    assert grads_and_vars[0][0].dtype == dtype
+    np.testing.assert_allclose(grads_and_vars[0][0].numpy(), expected_grad)
+
+    # The first Adam step moves the variable by the learning rate.
+    optimizer.apply_gradients([(tf.constant(8.0, dtype=dtype), variable)])
+    assert variable.dtype == dtype
+    np.testing.assert_allclose(variable.numpy(), 0.0, atol=1e-3)
@@ -0,0 +1,85 @@
+# Copyright (c) 2022 Graphcore Ltd. All rights reserved.
+import numba
+import numpy as np
+import pytest
+import scipy.sparse as sp
+
+from data_utils.subgraph_extraction import (compile_subgraph_extraction,
+                                            count_subgraph_edges,
+                                            extract_subgraph_edges,
+                                            fill_subgraph_edges,
+                                            get_num_edges_per_cluster,
+                                            take_rows)
+
+
+@pytest.mark.parametrize("nodes", [[0, 1, 2], [3, 1, 0], [4], []])
+def test_extract_subgraph_edges(nodes):
+    edges = np.array([[0, 1], [1, 0], [1, 2], [2, 1], [2, 3], [3, 0], [4, 4]])
+    adjacency = sp.csr_matrix(
+        (np.arange(1, edges.shape[0] + 1, dtype=np.float32),
+         (edges[:, 0], edges[:, 1])),
+        shape=(5, 5)
+    )
+    nodes = np.array(nodes, dtype=np.int32)
+
+    rows, cols, edge_ids = extract_subgraph_edges(adjacency, nodes)
+
+    expected_adjacency = adjacency[nodes, :][:, nodes].toarray()
+    subgraph_adjacency = sp.coo_matrix(
+        (adjacency.data[edge_ids], (rows, cols)),
+        shape=(nodes.size, nodes.size)
+    ).toarray()
+    np.testing.assert_array_equal(subgraph_adjacency, expected_adjacency)
+    assert rows.dtype == np.int32
+    assert cols.dtype == np.int32
+    # Edges are in CSR order.
+    assert np.all(np.diff(rows) >= 0)
+
+
+@pytest.mark.parametrize("index_dtype", [np.int32, np.int64])
+def test_compile_subgraph_extraction(index_dtype):
+    adjacency = sp.eye(3, format="csr", dtype=np.float32)
+    adjacency.indptr = adjacency.indptr.astype(index_dtype)
+    adjacency.indices = adjacency.indices.astype(index_dtype)
+    nodes_dtype = np.int64
+
+    compile_subgraph_extraction(adjacency, nodes_dtype)
+
+    signatures = count_subgraph_edges.signatures + fill_subgraph_edges.signatures
+    assert any(signature[0].dtype == numba.from_dtype(np.dtype(index_dtype))
+               and signature[2].dtype == numba.from_dtype(np.dtype(nodes_dtype))
+               for signature in signatures)
+
+
+def test_get_num_edges_per_cluster():
+    edges = np.array([[0, 1], [1, 0], [1, 2], [2, 1], [2, 3], [3, 0], [4, 4], [5, 4]])
+    adjacency = sp.csr_matrix(
+        (np.ones(edges.shape[0], dtype=np.float32),
+         (edges[:, 0], edges[:, 1])),
+        shape=(6, 6)
+    )
+    # Node 5 is not in any cluster.
+    clusters = [np.array([2, 0, 1]), np.array([], dtype=np.int32), np.array([4, 3])]
+    cluster_offsets = np.zeros(len(clusters) + 1, dtype=np.int32)
+    np.cumsum([len(cluster) for cluster in clusters], out=cluster_offsets[1:])
+    cluster_nodes = np.concatenate(clusters).astype(np.int32)
+
+    num_edges = get_num_edges_per_cluster(adjacency, cluster_nodes, cluster_offsets)
+
+    expected_num_edges = [adjacency[nodes, :][:, nodes].nnz for nodes in clusters]
+    np.testing.assert_array_equal(num_edges, expected_num_edges)
+
+
+@pytest.mark.parametrize("dtype", [np.float16, np.float32, np.int8])
+@pytest.mark.parametrize("memory_mapped", [False, True])
+def test_take_rows(tmp_path, dtype, memory_mapped):
+    source = np.arange(24).reshape(6, 4).astype(dtype)
+    if memory_mapped:
+        np.save(tmp_path / "source.npy", source)
+        source = np.load(tmp_path / "source.npy", mmap_mode="r")
+    rows = np.array([5, 0, 2, 0], dtype=np.int32)
+    out = np.empty((rows.size, 4), dtype=dtype)
+
+    take_rows(source, rows, out)
+
+    np.testing.assert_array_equal(out, np.take(source, rows, axis=0))
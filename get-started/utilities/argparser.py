@@ -108,6 +108,13 @@ def add_arguments(parser):
     parser.add_argument("--compile-only",
                         type=str_to_bool,
                         help="Enable compile only mode.")
+    parser.add_argument("--evaluation-snapshot-path",
+                        type=str,
+                        help=("Path to the directory where the validation and test"
+                              " batches are snapshotted, to reuse them across runs."))
+    parser.add_argument("--executable-cache-path",
+                        type=str,
+                        help="Path to the directory where the compiled executables are cached.")
     parser.add_argument("--calculate-cluster-statistics",
                         type=str_to_bool,
                         help=("Enable/disable statistics of the clusters"
@@ -1,6 +1,7 @@
 # Copyright (c) 2022 Graphcore Ltd. All rights reserved.
 
 import logging
+import os
 import random
 
 import numpy as np
@@ -100,6 +101,37 @@ def get_matmul_options(matmul_available_memory_proportion,
     }
 
 
+def get_feed_queue_depth(steps_per_execution, min_depth=10, max_depth=64):
+    """
+    Returns a depth for the infeed and outfeed queues that matches the
+    number of steps run on device per execution, so the device is not
+    left waiting on the host to supply or drain the queues.
+    :param steps_per_execution: Int representing the number of steps
+        the model is compiled to run per execution.
+    :param min_depth: Int representing the smallest depth to use.
+    :param max_depth: Int representing the largest depth to use, which
+        bounds the host memory used by the queues.
+    :return: Int representing the queue depth.
+    """
+    return int(np.clip(steps_per_execution, min_depth, max_depth))
+
+
+def set_executable_cache_path(executable_cache_path):
+    """
+    Sets the directory where the compiled executables are cached, so a
+    model compiled in a previous run with the same shapes and options is
+    loaded instead of compiled again. This must be called before the IPU
+    system is configured. A cache path already given in TF_POPLAR_FLAGS,
+    for example by `poprun`, takes precedence.
+    :param executable_cache_path: Path to the cache directory.
+    """
+    poplar_flags = os.environ.get("TF_POPLAR_FLAGS", "")
+    if "--executable_cache_path" in poplar_flags:
+        return
+    os.environ["TF_POPLAR_FLAGS"] = (
+        f"{poplar_flags} --executable_cache_path={executable_cache_path}".strip())
+
+
 def set_random_seeds(seed=42):
     ipu.utils.reset_ipu_seed(seed)
     np.random.seed(seed)
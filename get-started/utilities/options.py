@@ -57,6 +57,7 @@ class AdjacencyOptions(BaseModel):
     transform_mode: str
     diag_lambda: Optional[float]
     regularisation: Optional[float]
+    precompute_normalisation: bool = False
 
     @root_validator()
     def check_needed_parameters_per_option(cls, values):
@@ -86,6 +87,14 @@ class AdjacencyOptions(BaseModel):
                 raise ValueError("'diag_lambda' parameter is needed in config file.")
             warn_unused_parameters(warn_reg=True)
 
+        if values.get("precompute_normalisation") and transform_mode not in [
+            "normalised",
+            "normalised_regularised"
+        ]:
+            raise ValueError(
+                "'precompute_normalisation' is only supported with the"
+                " 'normalised' and 'normalised_regularised' transform modes.")
+
         return values
 
     @validator("transform_mode", always=True)
@@ -117,6 +126,19 @@ class IPUConfigOptions(BaseModel):
     # can sacrifice from computation to improve IO.
     num_io_tiles: int = 0
 
+    # Number of batches staged in the infeed ahead of the step consuming
+    # them, so the transfer of the next batch overlaps the current step.
+    # If not set, this matches the number of steps per execution.
+    infeed_prefetch_depth: Optional[PositiveInt] = None
+
+    @root_validator()
+    def check_infeed_prefetch_with_io_tiles(cls, values):
+        if values.get("infeed_prefetch_depth") and not values.get("num_io_tiles"):
+            logging.warning("'infeed_prefetch_depth' is set but 'num_io_tiles' is 0,"
+                            " so the infeed transfers will not overlap with the"
+                            " compute. Set 'num_io_tiles' to enable this.")
+        return values
+
     @root_validator()
     def check_pipeline_stages_compatibility(cls, values):
         num_pipeline_stages = len(values.get("pipeline_stages"))
@@ -154,7 +176,8 @@ class SetOptions(BaseModel):
     micro_batch_size: int = 1
     gradient_accumulation_steps_per_replica: int
     replicas: PositiveInt = 1
-    dataset_prefetch_depth: int = 10
+    # If not set, the prefetch depth is tuned dynamically by tf.data.
+    dataset_prefetch_depth: Optional[PositiveInt] = None
 
     # Clustering
     max_nodes_per_batch: Optional[int]
@@ -172,7 +195,9 @@ class SetOptions(BaseModel):
 
     device: str = "ipu"
 
-    use_sparse_representation: bool = False
+    # If not set, the sparse representation is used on IPU, where
+    # it minimises IO, and the dense representation otherwise.
+    use_sparse_representation: Optional[bool] = None
 
     @validator("micro_batch_size", always=True)
     def micro_batch_size_limit(cls, value):
@@ -194,6 +219,12 @@ class SetOptions(BaseModel):
                             " replaced with their generic equivalent.")
         return value
 
+    @validator("use_sparse_representation", always=True)
+    def default_sparse_representation_for_device(cls, value, values):
+        if value is None:
+            return values.get("device") == "ipu"
+        return value
+
     @root_validator(pre=False)
     def precision_type_match(cls, values):
         precision = values.get("precision")
@@ -278,6 +309,9 @@ class Options(BaseModel):
     pca_features_path: Path = None
     regenerate_dataset_cache: bool = False
     save_dataset_cache: bool = True
+    # If set, the evaluation batches are snapshotted to this directory,
+    # so later runs read them back instead of assembling them again.
+    evaluation_snapshot_path: Optional[Path] = None
 
     # Logging
     name: str = "Cluster-GCN"
@@ -293,6 +327,7 @@ class Options(BaseModel):
     # Misc.
     seed: int
     compile_only: bool = False
+    executable_cache_path: Optional[Path] = None
     fp_exceptions: bool = False
 
     @root_validator(pre=True)
@@ -149,6 +149,10 @@ def sparse_tuple_add_diag(sp_a, sp_diag):
 def sparse_tuple_dense_matmul(sp_a, b):
     """
     We assume the adjacency has no zero rows/columns, otherwise we would have to scatter.
+    The edges are expected in CSR order, as produced by the batch generator. The row of an
+    edge is the node its message is aggregated into, so the segment sum reduces contiguous
+    edges for each destination node. The unsorted segment sum is still used, as it keeps
+    the static number of segments when the padding edges are clipped.
     """
     y = tf.expand_dims(values_(sp_a), axis=-1) * tf.gather(b, indices_(sp_a)[:, 1])
     z = tf.math.unsorted_segment_sum(y, indices_(sp_a)[:, 0], num_segments=shape_(sp_a)[0])
@@ -1,8 +1,10 @@
 # Copyright (c) 2022 Graphcore Ltd. All rights reserved.
 
+import os
 from datetime import datetime
 
 import numpy as np
+import scipy.sparse as sp
 import tensorflow as tf
 
 from tensorflow.python.ipu import horovod
@@ -12,15 +14,15 @@ from utilities.constants import AdjacencyForm, MethodMaxNodesEdges
 def get_adjacency_form(device, use_sparse_representation):
     if not use_sparse_representation:
         return AdjacencyForm.DENSE
-    if device == "cpu" and use_sparse_representation:
-        return AdjacencyForm.SPARSE_TENSOR
-    if device == "ipu" and use_sparse_representation:
-        return AdjacencyForm.SPARSE_TUPLE
+    # The sparse adjacency is fed as a padded tuple on any device, as
+    # its static shape lets the input pipeline run ahead.
+    return AdjacencyForm.SPARSE_TUPLE
 
 
-def get_adjacency_dtype(device, use_sparse_representation):
-    if use_sparse_representation and device == "cpu":
-        # If using SparseTensor on CPU we can only allow float32.
+def get_adjacency_dtype(device, use_sparse_representation, precompute_normalisation=False):
+    if precompute_normalisation:
+        # The normalised values must be fed to the model, and the
+        # CSR matrix doesn't support float16.
         return np.float32
     else:
         # For dense and sparse tuple the adjacency can be a bool
@@ -28,6 +30,17 @@ def get_adjacency_dtype(device, use_sparse_representation):
         return np.bool
 
 
+def get_adjacency_indices_dtype(adjacency_form, max_nodes_per_batch):
+    """
+    Returns the narrowest dtype that can hold the node indices of the
+    adjacency edges in a batch, to minimize IO for the sparse tuple.
+    """
+    if (adjacency_form == AdjacencyForm.SPARSE_TUPLE and
+            max_nodes_per_batch <= np.iinfo(np.uint16).max + 1):
+        return np.uint16
+    return np.int32
+
+
 def get_method_max(method_max_str):
     if method_max_str == "average":
         return MethodMaxNodesEdges.AVERAGE
@@ -48,6 +61,31 @@ def decompose_sparse_adjacency(adjacency_coo):
     return indices, values, shape
 
 
+def to_canonical_csr(adjacency):
+    """
+    Returns the adjacency as a CSR matrix with sorted indices and no
+    duplicated edges, so the edges of each node are a contiguous,
+    ordered slice of the indices. An adjacency already in this form is
+    returned without copying.
+    """
+    adjacency = sp.csr_matrix(adjacency)
+    if not adjacency.has_canonical_format:
+        adjacency = adjacency.copy()
+        adjacency.sum_duplicates()
+    return adjacency
+
+
+def get_num_available_cpus():
+    """
+    Returns the number of CPUs this process can run on, which is fewer
+    than the CPUs of the host when, for example, the instances of a
+    distributed run are bound to different NUMA nodes.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
+
+
 def get_time_now(distributed_training):
     if distributed_training:
         time_now = float(